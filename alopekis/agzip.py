@@ -1,14 +1,33 @@
+import argparse
 import os
 import glob
 import gzip
 import shutil
 
+from alopekis.compression import ParallelGzipFile
+from alopekis.config import COMPRESSION_THREADS
 
 
-os.chdir('/work/pidgraph/staging')
-files = glob.glob('*/*.jsonl')
-for filename in files:
+def gzip_file(filename: str, threads: int = COMPRESSION_THREADS) -> None:
+    """Compress a file to `{filename}.gz`, in parallel blocks if `threads` is above 0"""
     with open(filename, "rb") as f_in:
-        with gzip.open(f"{filename}.gz", "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)  # You forgot this line in your example.
-    print(f"success. Zipped {filename}")
\ No newline at end of file
+        if threads > 0:
+            with open(f"{filename}.gz", "wb") as raw_out, ParallelGzipFile(raw_out, threads=threads) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            with gzip.open(f"{filename}.gz", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)  # You forgot this line in your example.
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs="?", default="/work/pidgraph/staging", help="Directory to compress files in")
+    parser.add_argument("-t", "--threads", type=int, default=COMPRESSION_THREADS,
+                        help="Compression threads, 0 for a single gzip stream")
+    args = parser.parse_args()
+
+    os.chdir(args.directory)
+    files = glob.glob('*/*.jsonl')
+    for filename in files:
+        gzip_file(filename, threads=args.threads)
+        print(f"success. Zipped {filename}")
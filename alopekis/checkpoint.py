@@ -0,0 +1,76 @@
+import json
+import os
+from glob import iglob
+
+from .config import OUTPUT_PATH
+
+# Job fields that must match for a checkpoint to be resumed
+JOB_IDENTITY_FIELDS = ('year', 'month', 'part', 'parts', 'from', 'until', 'pit_id')
+
+
+def checkpoint_path(output_dir: str, file_prefix: str = "") -> str:
+    """Return the path of the checkpoint file for a job writing to `output_dir`"""
+    return f"{output_dir}/.{file_prefix}checkpoint.json"
+
+
+def job_identity(job: dict) -> dict:
+    """Return the fields of a job that identify the work it covers"""
+    return {field: job.get(field) for field in JOB_IDENTITY_FIELDS}
+
+
+def save_checkpoint(path: str, job: dict, ranges: list, positions: dict, part_index: int, count: int,
+                    csv_offset: int) -> None:
+    """Record how far a job has got, replacing any earlier checkpoint atomically
+
+    Args:
+        path (str): Path of the checkpoint file.
+        job (dict): The job being processed.
+        ranges (dict): The `updated` ranges covered by the cursors of each stream, keyed by stream name.
+        positions (dict): Sort values of the last record written by each cursor, keyed by stream name and then by
+            cursor index.
+        part_index (int): Index of the next JSONL part file to be written.
+        count (int): Number of records written so far.
+        csv_offset (int): Length of the CSV file up to the last complete compressed member.
+    """
+    checkpoint = {
+        'job': job_identity(job),
+        'ranges': ranges,
+        'positions': {stream: {str(cursor): sort for cursor, sort in cursors.items()}
+                      for stream, cursors in positions.items()},
+        'part_index': part_index,
+        'count': count,
+        'csv_offset': csv_offset,
+    }
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_checkpoint(path: str, job: dict):
+    """Load the checkpoint for a job, if one exists and was written for the same job
+
+    Returns:
+        dict: The checkpoint, with the `positions` of each stream keyed by integer cursor index, or None.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('job') != job_identity(job):
+        return None
+    checkpoint['positions'] = {stream: {int(cursor): sort for cursor, sort in cursors.items()}
+                               for stream, cursors in checkpoint['positions'].items()}
+    return checkpoint
+
+
+def remove_checkpoint(path: str) -> None:
+    """Remove a job's checkpoint once the job has finished"""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def clear_checkpoints() -> None:
+    """Remove checkpoints left behind by an earlier run"""
+    for path in iglob(f"{OUTPUT_PATH}/dois/*/.*checkpoint.json"):
+        os.remove(path)
@@ -0,0 +1,197 @@
+import gzip
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .config import COMPRESSION_THREADS, COMPRESSION_BLOCK_SIZE, COMPRESSION_CODEC, COMPRESSION_LEVEL
+
+# File extension, S3 ContentType and default level of each output codec
+CODECS = {
+    "gzip": {"extension": ".gz", "content_type": "application/gzip", "level": 9, "levels": range(0, 10)},
+    "zstd": {"extension": ".zst", "content_type": "application/zstd", "level": 3, "levels": range(1, 23)},
+}
+
+# Size of the deflate window, the amount of preceding data each block may refer back to
+WINDOW_SIZE = 32 * 1024
+
+_executors = {}
+_executors_pid = None
+_executors_lock = threading.Lock()
+
+
+def get_executor(threads: int) -> ThreadPoolExecutor:
+    """Return the compression thread pool of the current process with `threads` threads, creating it on first use"""
+    global _executors, _executors_pid
+    with _executors_lock:
+        if _executors_pid != os.getpid():
+            # Thread pools do not survive a fork
+            _executors = {}
+            _executors_pid = os.getpid()
+        if threads not in _executors:
+            _executors[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="compress")
+        return _executors[threads]
+
+
+def compress_block(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    """Compress one block to raw deflate data that continues the stream of the blocks before it
+
+    The compressor is primed with the end of the previous block, so matches can still reach back across block
+    boundaries. Every block but the last ends on a byte boundary, so the blocks can simply be concatenated.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(io.BufferedIOBase):
+    def __init__(self, fileobj, compresslevel=9, block_size=COMPRESSION_BLOCK_SIZE, threads=COMPRESSION_THREADS):
+        """
+        Initialize a ParallelGzipFile object.
+
+        Writes a single gzip member to `fileobj`, like `gzip.GzipFile(fileobj=..., mode="wb")`, but compresses
+        it in independent blocks of `block_size` bytes on a thread pool, in the same way as pigz. zlib releases
+        the GIL while compressing, so the blocks are compressed in parallel. The output is a standard gzip
+        member, readable by `gzip` and `zcat`.
+
+        Closing the object finishes the member but leaves `fileobj` open.
+
+        Args:
+            fileobj: Binary file to write to.
+            compresslevel (int): zlib compression level.
+            block_size (int): Size of the uncompressed blocks, in bytes.
+            threads (int): Number of compression threads in the process-wide pool.
+        """
+        super().__init__()
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.executor = get_executor(max(threads, 1))
+        # Blocks being compressed, in order, bounded so memory use does not grow with a slow disk
+        self.pending = deque()
+        self.max_pending = max(threads, 1) * 2
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self._write_header()
+
+    def _write_header(self):
+        xfl = 2 if self.compresslevel == 9 else 4 if self.compresslevel == 1 else 0
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<L", int(time.time())) + bytes([xfl, 255]))
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.buffer += data
+        while len(self.buffer) > self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.executor.submit(compress_block, block, self.dictionary, self.compresslevel, last))
+        self.dictionary = block[-WINDOW_SIZE:]
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def _write_pending(self):
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        """Compress and write out everything written so far"""
+        if self.closed:
+            return
+        if self.buffer:
+            block = bytes(self.buffer)
+            self.buffer.clear()
+            self._submit(block, last=False)
+        self._write_pending()
+        self.fileobj.flush()
+
+    def close(self):
+        """Finish the gzip member, leaving `fileobj` open"""
+        if self.closed:
+            return
+        try:
+            block = bytes(self.buffer)
+            self.buffer.clear()
+            self._submit(block, last=True)
+            self._write_pending()
+            self.fileobj.write(struct.pack("<LL", self.crc, self.size & 0xffffffff))
+        finally:
+            super().close()
+
+
+class Codec(NamedTuple):
+    """The compression format and level of the output files"""
+    name: str
+    level: int
+
+    @property
+    def extension(self) -> str:
+        return CODECS[self.name]["extension"]
+
+    @property
+    def content_type(self) -> str:
+        return CODECS[self.name]["content_type"]
+
+    def open_member(self, raw_file, threads: int = COMPRESSION_THREADS) -> io.BufferedIOBase:
+        """Start a new compressed member at the end of an open binary file and return a binary stream that writes to it
+
+        For gzip this is a gzip member, compressed in parallel blocks by a `ParallelGzipFile` if `threads` is above
+        0, and for zstd a zstd frame, compressed by zstd's own worker threads. Members of either codec decompress
+        as a single stream when concatenated. Closing the returned stream finishes the member but leaves
+        `raw_file` open for the next one.
+        """
+        if self.name == "zstd":
+            compressor = zstandard.ZstdCompressor(level=self.level, threads=threads)
+            return compressor.stream_writer(raw_file, closefd=False)
+        if threads > 0:
+            return ParallelGzipFile(raw_file, compresslevel=self.level, threads=threads)
+        return gzip.GzipFile(fileobj=raw_file, mode="wb", compresslevel=self.level)
+
+
+def get_codec(name: str = None, level: int = None) -> Codec:
+    """Return the output codec, by default the one set in the configuration
+
+    Args:
+        name (str): `gzip` or `zstd`.
+        level (int): Compression level, or None for the default level of the codec.
+
+    Raises:
+        ValueError: The codec is unknown, the level is out of range for the codec, or the codec is zstd and the
+            `zstandard` package is not installed.
+    """
+    name = (name or COMPRESSION_CODEC).lower()
+    if name not in CODECS:
+        raise ValueError(f"Unknown compression codec: {name}, expected one of {', '.join(CODECS)}")
+    if name == "zstd" and zstandard is None:
+        raise ValueError("The zstd codec needs the zstandard package, install it with `poetry install --extras zstd`")
+    if level is None:
+        level = COMPRESSION_LEVEL
+    if level is None:
+        level = CODECS[name]["level"]
+    levels = CODECS[name]["levels"]
+    if level not in levels:
+        raise ValueError(f"Invalid {name} compression level: {level}, expected {levels.start} to {levels.stop - 1}")
+    return Codec(name, level)
@@ -9,10 +9,92 @@ OPENSEARCH_HOST = getenv('OPENSEARCH_HOST', 'localhost')
 OPENSEARCH_PORT = getenv('OPENSEARCH_PORT', '9203')
 OPENSEARCH_INDEX = getenv('OPENSEARCH_INDEX', 'dois')
 
+# Each process keeps one OpenSearch client with up to OPENSEARCH_POOL_SIZE persistent connections
+OPENSEARCH_POOL_SIZE = int(getenv('OPENSEARCH_POOL_SIZE', 16))
+OPENSEARCH_TIMEOUT = int(getenv('OPENSEARCH_TIMEOUT', 60))
+
+# Point-in-time shared by the whole run, kept alive by a refresh every PIT_REFRESH_INTERVAL seconds
+PIT_KEEP_ALIVE = getenv('PIT_KEEP_ALIVE', '30m')
+PIT_REFRESH_INTERVAL = int(getenv('PIT_REFRESH_INTERVAL', 300))
+
 # Application settings
 OUTPUT_PATH = getenv('OUTPUT_PATH', '/work/stage-test')
 WORKERS = getenv('WORKERS', 8)
 
+# search_after page size, adapted between PAGE_SIZE_MIN and PAGE_SIZE_MAX to keep each page under PAGE_TARGET_TOOK
+# milliseconds and PAGE_MAX_BYTES of response body when ADAPTIVE_PAGE_SIZE is enabled
+PAGE_SIZE = int(getenv('PAGE_SIZE', 1000))
+ADAPTIVE_PAGE_SIZE = getenv('ADAPTIVE_PAGE_SIZE', 'true').lower() in ('1', 'true', 'yes')
+PAGE_SIZE_MIN = int(getenv('PAGE_SIZE_MIN', 100))
+PAGE_SIZE_MAX = int(getenv('PAGE_SIZE_MAX', 5000))
+PAGE_TARGET_TOOK = int(getenv('PAGE_TARGET_TOOK', 2000))
+PAGE_MAX_BYTES = int(getenv('PAGE_MAX_BYTES', 20 * 1024 * 1024))
+
+# Number of pages fetched ahead of serialization on a background thread (0 to disable)
+PREFETCH_DEPTH = int(getenv('PREFETCH_DEPTH', 2))
+
+# Records are handed between the fetch, serialize and write stages of a worker in batches of PIPELINE_BATCH_SIZE,
+# with up to PIPELINE_DEPTH batches waiting between each pair of stages
+PIPELINE_BATCH_SIZE = int(getenv('PIPELINE_BATCH_SIZE', 1000))
+PIPELINE_DEPTH = int(getenv('PIPELINE_DEPTH', 4))
+
+# Serialized records are compressed once WRITE_BUFFER_BYTES have been collected. DURABILITY sets when output reaches
+# the disk: "page" flushes after every page, "part" syncs at every part rotation, "never" leaves it to the OS
+WRITE_BUFFER_BYTES = int(getenv('WRITE_BUFFER_BYTES', 1024 * 1024))
+DURABILITY = getenv('DURABILITY', 'part').lower()
+
+# JSON encoder of the JSONL parts, ujson or orjson (which needs the orjson package). Both produce the same output
+JSON_BACKEND = getenv('JSON_BACKEND', 'ujson').lower()
+
+# Output codec, gzip or zstd (which needs the zstandard package), and its level, by default 9 for gzip and 3 for zstd
+COMPRESSION_CODEC = getenv('COMPRESSION_CODEC', 'gzip')
+COMPRESSION_LEVEL = int(getenv('COMPRESSION_LEVEL')) if getenv('COMPRESSION_LEVEL') else None
+
+# gzip output is compressed in blocks of COMPRESSION_BLOCK_SIZE bytes on COMPRESSION_THREADS threads per worker, or as a
+# single gzip stream when COMPRESSION_THREADS is 0. zstd output uses COMPRESSION_THREADS zstd worker threads
+COMPRESSION_THREADS = int(getenv('COMPRESSION_THREADS', 0))
+COMPRESSION_BLOCK_SIZE = int(getenv('COMPRESSION_BLOCK_SIZE', 128 * 1024))
+
+# A new JSONL part is started once the current one holds PART_MAX_RECORDS findable records or, checked after each
+# batch of PIPELINE_BATCH_SIZE records, PART_MAX_BYTES of uncompressed JSON (0 for no byte limit). Jobs are
+# checkpointed at every new part
+PART_MAX_RECORDS = int(getenv('PART_MAX_RECORDS', 10000))
+PART_MAX_BYTES = int(getenv('PART_MAX_BYTES', 0))
+
+# Months with at least SLICE_MIN_COUNT records are fetched by SLICES concurrent cursors over contiguous ranges of
+# `updated`. Records are in sort order within each slice, but the slices are interleaved as they are fetched
+SLICES = int(getenv('SLICES', 1))
+SLICE_MIN_COUNT = int(getenv('SLICE_MIN_COUNT', 1000000))
+
+# Months with more than MAX_JOB_SIZE records are split into several jobs (0 to disable)
+MAX_JOB_SIZE = int(getenv('MAX_JOB_SIZE', 1000000))
+
+# Retries of failed searches back off exponentially from RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds, with
+# RETRY_BUDGET retries shared by every worker in the run
+RETRY_BASE_DELAY = float(getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(getenv('RETRY_MAX_DELAY', 60))
+RETRY_MAX_FAILURES = int(getenv('RETRY_MAX_FAILURES', 10))
+RETRY_MAX_TIMEOUTS = int(getenv('RETRY_MAX_TIMEOUTS', 10))
+RETRY_BUDGET = int(getenv('RETRY_BUDGET', 500))
+
+# Jobs that fail with too many search failures, or whose worker dies, are requeued up to JOB_RETRIES times, resuming
+# from their checkpoint. Dead workers are looked for and replaced every SUPERVISE_INTERVAL seconds. Workers that die
+# without a job, such as on startup, are replaced up to WORKER_RESTARTS times before the run is aborted
+JOB_RETRIES = int(getenv('JOB_RETRIES', 2))
+SUPERVISE_INTERVAL = float(getenv('SUPERVISE_INTERVAL', 5))
+WORKER_RESTARTS = int(getenv('WORKER_RESTARTS', 5))
+
+# Jobs are queued longest first, predicted from the seconds per record each month took in earlier runs, or from
+# DEFAULT_SECONDS_PER_RECORD when no run has been measured yet
+DEFAULT_SECONDS_PER_RECORD = float(getenv('DEFAULT_SECONDS_PER_RECORD', 0.0005))
+
+# Workers report the progress of their job every HEARTBEAT_INTERVAL seconds (0 to disable). A job that makes no
+# progress for STALL_TIMEOUT seconds is flagged as stalled and, with STALL_CANCEL, marked in cancelled_jobs. Its worker
+# checks the mark after each heartbeat and stops the job with JobCancelled, requeueing it to resume from its checkpoint
+HEARTBEAT_INTERVAL = float(getenv('HEARTBEAT_INTERVAL', 30))
+STALL_TIMEOUT = float(getenv('STALL_TIMEOUT', 600))
+STALL_CANCEL = getenv('STALL_CANCEL', 'true').lower() in ('1', 'true', 'yes')
+
 # METRICS
 TOTAL_THRESHOLD = getenv('TOTAL_THRESHOLD', 1000)
 MONTH_THRESHOLD = getenv('MONTH_THRESHOLD', 400)
@@ -20,4 +102,19 @@ CIRCUIT_BREAKER_THRESHOLD = getenv('CIRCUIT_BREAKER_THRESHOLD', 3)
 
 # AWS Settings
 DATAFILE_BUCKET = getenv('DATAFILE_BUCKET', 'datafile-stage')
-LOG_BUCKET = getenv('LOG_BUCKET', 'datafile-logs')
\ No newline at end of file
+LOG_BUCKET = getenv('LOG_BUCKET', 'datafile-logs')
+
+# Months uploaded at once when uploads overlap generation
+UPLOAD_THREADS = int(getenv('UPLOAD_THREADS', 4))
+
+# With OUTPUT_BACKEND "s3", workers stream output straight into DATAFILE_BUCKET as multipart uploads instead of
+# writing under OUTPUT_PATH, holding at most S3_PART_SIZE bytes (5 MB or more) per open file. S3_ENDPOINT_URL points
+# every S3 call at another endpoint, such as a local moto server
+OUTPUT_BACKEND = getenv('OUTPUT_BACKEND', 'local').lower()
+S3_PART_SIZE = max(int(getenv('S3_PART_SIZE', 8 * 1024 * 1024)), 5 * 1024 * 1024)
+S3_ENDPOINT_URL = getenv('S3_ENDPOINT_URL')
+
+# The s3 backend and overlapping uploads write the data file under S3_STAGING_PREFIX in DATAFILE_BUCKET, which is
+# cleared at the start of each run. The staged objects are only copied over the published data file once the whole
+# data file is generated, so consumers never see a mix of old and new files next to the old MANIFEST
+S3_STAGING_PREFIX = getenv('S3_STAGING_PREFIX', 'staging/')
\ No newline at end of file
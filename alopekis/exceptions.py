@@ -9,4 +9,14 @@ class TooManyTimeouts(Exception):
 
 class TooManyFailures(Exception):
     """Raised when a worker encounters multiple failures when querying the OpenSearch index."""
-    pass
\ No newline at end of file
+    pass
+
+
+class JobCancelled(Exception):
+    """Raised when the results thread cancels a job that stopped making progress."""
+    pass
+
+
+class TooManyRestarts(Exception):
+    """Raised when too many workers die without a job, so the run is aborted."""
+    pass
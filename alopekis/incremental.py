@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+
+from .compression import Codec, get_codec
+from .config import OUTPUT_PATH
+
+FINGERPRINTS_FILE = "FINGERPRINTS.json"
+
+
+def month_key(year: int, month: int) -> str:
+    """Return the key used for a month in the fingerprints file"""
+    return f"{year}-{month:02d}"
+
+
+def month_fingerprint(bucket) -> dict:
+    """Build the fingerprint of a month from its bucket of the monthly `date_histogram`
+
+    The bucket needs the `max_updated` and `updated_sum` sub-aggregations. Any record added, removed or updated
+    in the month changes at least one of the count, the latest `updated` or the sum of `updated`.
+    """
+    return {
+        'count': bucket.doc_count,
+        'max_updated': bucket.max_updated.value,
+        'updated_sum': bucket.updated_sum.value,
+    }
+
+
+def load_fingerprints() -> dict:
+    """Load the month fingerprints stored by the previous run, or an empty dict if there are none"""
+    try:
+        with open(f"{OUTPUT_PATH}/{FINGERPRINTS_FILE}") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_fingerprints(fingerprints: dict) -> None:
+    """Store the month fingerprints for the next run"""
+    # The s3 backend writes nothing else under OUTPUT_PATH
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    with open(f"{OUTPUT_PATH}/{FINGERPRINTS_FILE}.tmp", "w") as f:
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+    os.replace(f"{OUTPUT_PATH}/{FINGERPRINTS_FILE}.tmp", f"{OUTPUT_PATH}/{FINGERPRINTS_FILE}")
+
+
+def month_unchanged(year: int, month: int, fingerprint: dict, previous: dict, codec: Codec = None) -> bool:
+    """Check whether a month can be carried over from the previous output tree
+
+    The month must have the same fingerprint as in the previous run, and its output must still be on disk in the
+    format of `codec`.
+    """
+    output_dir = f"{OUTPUT_PATH}/dois/updated_{year}-{month:02d}"
+    if previous.get(month_key(year, month)) != fingerprint:
+        return False
+    return fingerprint['count'] == 0 or os.path.isfile(f"{output_dir}/{year}-{month:02d}.csv{(codec or get_codec()).extension}")
+
+
+def remove_month(key: str) -> None:
+    """Remove the output of a month that no longer holds any records"""
+    shutil.rmtree(f"{OUTPUT_PATH}/dois/updated_{key}", ignore_errors=True)
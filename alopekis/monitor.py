@@ -0,0 +1,104 @@
+import time
+
+from .config import STALL_TIMEOUT, STALL_CANCEL
+
+
+def job_label(job: dict) -> str:
+    """Return the month of a job or result, with its part for a split month"""
+    label = f"{job['year']}-{job['month']}"
+    if job.get('parts', 1) > 1:
+        label += f" (part {job['part'] + 1}/{job['parts']})"
+    return label
+
+
+class JobMonitor:
+    def __init__(self, logger, current_jobs=None, cancelled_jobs=None, stall_timeout: float = STALL_TIMEOUT,
+                 cancel: bool = STALL_CANCEL):
+        """
+        Initialize a JobMonitor object.
+
+        Follows the heartbeats workers send while they process a job, to tell a job that is slowly making progress
+        from one that is stuck. The throughput of each job is measured from its heartbeats, and a job whose record
+        count has not moved for `stall_timeout` seconds, or that has stopped sending heartbeats altogether, is
+        flagged as stalled. With `cancel`, the stalled job is then marked as cancelled in `cancelled_jobs`, which
+        its worker checks after every heartbeat, giving the job back to the queue to resume from its checkpoint.
+        The job is identified down to its attempt, so a worker that has moved on to another job ignores the mark.
+
+        Args:
+            logger: Logger to report throughput and stalls to.
+            current_jobs (dict): Shared dict of the job each worker is processing, keyed by worker ID, so that a job
+                the worker has already given up on is not flagged.
+            cancelled_jobs (dict): Shared dict of the job to cancel on each worker, keyed by worker ID.
+            stall_timeout (float): Seconds without progress before a job counts as stalled, 0 to never flag one.
+            cancel (bool): Cancel stalled jobs.
+        """
+        self.logger = logger
+        self.stall_timeout = stall_timeout
+        self.cancel = cancel
+        self.current_jobs = current_jobs
+        self.cancelled_jobs = cancelled_jobs
+        # Progress of the job each worker is processing, keyed by worker ID
+        self.jobs = {}
+
+    def heartbeat(self, beat: dict) -> None:
+        """Record a heartbeat, starting a new entry if the worker has moved on to another job"""
+        now = time.monotonic()
+        job = (beat['year'], beat['month'], beat.get('part', 0), beat.get('attempt', 0))
+        entry = self.jobs.get(beat['worker'])
+        if entry is None or entry['job'] != job:
+            entry = {'job': job, 'started': now, 'start_count': beat['count'], 'count': beat['count'],
+                     'progressed': now}
+            self.jobs[beat['worker']] = entry
+        if beat['count'] > entry['count']:
+            entry['progressed'] = now
+        entry.update(beat=beat, count=beat['count'], seen=now)
+
+        elapsed = now - entry['started']
+        rate = (beat['count'] - entry['start_count']) / elapsed if elapsed > 0 else 0.0
+        entry['rate'] = rate
+        self.logger.debug(f"Job for {job_label(beat)} on worker {beat['worker']}: {beat['count']}/{beat['expected']} "
+                          f"records, {beat['pages']} pages, {beat['bytes'] / 1024 / 1024:.1f} MB, {rate:.0f} records/s")
+
+    def job_done(self, result: dict) -> None:
+        """Stop following a job once its final result is in"""
+        for worker_id, entry in list(self.jobs.items()):
+            if entry['job'][:3] == (result['year'], result['month'], result.get('part', 0)):
+                elapsed = time.monotonic() - entry['started']
+                self.logger.info(f"Job for {job_label(result)} on worker {worker_id} ran at "
+                                 f"{(result['count'] - entry['start_count']) / elapsed if elapsed > 0 else 0:.0f} "
+                                 f"records/s")
+                del self.jobs[worker_id]
+
+    def check(self) -> list:
+        """Flag the jobs that have made no progress for longer than the stall timeout, cancelling them if enabled
+
+        Returns:
+            list: The worker IDs of the stalled jobs.
+        """
+        if not self.stall_timeout:
+            return []
+        now = time.monotonic()
+        stalled = []
+        for worker_id, entry in list(self.jobs.items()):
+            idle = now - entry['progressed']
+            if idle < self.stall_timeout:
+                continue
+            beat = entry['beat']
+            if self.current_jobs is not None:
+                current = self.current_jobs.get(worker_id)
+                if current is None or (current['year'], current['month'], current.get('part', 0),
+                                       current.get('attempt', 0)) != entry['job']:
+                    # The job was requeued or the worker died, the supervisor has taken care of it
+                    del self.jobs[worker_id]
+                    continue
+            stalled.append(worker_id)
+            self.logger.warning(f"Job for {job_label(beat)} on worker {worker_id} stalled: no progress for "
+                                f"{idle:.0f}s at {beat['count']}/{beat['expected']} records "
+                                f"(last heartbeat {now - entry['seen']:.0f}s ago, {entry['rate']:.0f} records/s), "
+                                f"search_after {beat['search_after']}")
+            if self.cancel and self.cancelled_jobs is not None:
+                self.logger.warning(f"Cancelling job for {job_label(beat)} on worker {worker_id}, it will be requeued")
+                self.cancelled_jobs[worker_id] = entry['job']
+            # Forget the job, a new entry starts if the worker keeps sending heartbeats for it
+            del self.jobs[worker_id]
+        return stalled
@@ -1,96 +1,401 @@
 import calendar
+import heapq
 import logging
+import os
+import threading
 import time
+from operator import itemgetter
+from queue import Queue, Empty, Full
+from typing import NamedTuple
 
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from opensearch_dsl import Search
-from .config import OPENSEARCH_HOST, OPENSEARCH_PORT, OPENSEARCH_INDEX
-from .exceptions import TooManyFailures, TooManyTimeouts
+from .config import OPENSEARCH_HOST, OPENSEARCH_PORT, OPENSEARCH_INDEX, OPENSEARCH_POOL_SIZE, OPENSEARCH_TIMEOUT, \
+    PIT_KEEP_ALIVE, PREFETCH_DEPTH, PAGE_SIZE, ADAPTIVE_PAGE_SIZE
+from .paging import AdaptivePageSize
+from .retry import RetryPolicy, classify_failure
+
+# Only the parts of a search response needed to page through the results
+RAW_FILTER_PATH = ["took", "timed_out", "hits.hits._source", "hits.hits.sort"]
+
+# Fields needed to write a record to the CSV file, all that is fetched for registered records
+CSV_FIELDS = ["uid", "aasm_state", "client_id", "updated"]
+
+
+class Page(NamedTuple):
+    """A page of hits from one `search_after` cursor"""
+    hits: list
+    sorts: list
+    cursor: int
+
+
+class MeteredHttpConnection(RequestsHttpConnection):
+    """RequestsHttpConnection that records the size of the last response body received on each thread"""
+    last_response = threading.local()
+
+    def perform_request(self, *args, **kwargs):
+        status, headers, raw_data = super().perform_request(*args, **kwargs)
+        MeteredHttpConnection.last_response.size = len(raw_data)
+        return status, headers, raw_data
+
+
+_opensearch = {}
+_opensearch_lock = threading.Lock()
+
+
+def get_opensearch():
+    """Return the `OpenSearch` client for the current process, creating it with settings from the config file on first use
+
+    The client is keyed by PID, so a process forked from one that already holds a client builds its own rather
+    than sharing the parent's sockets.
+    """
+    pid = os.getpid()
+    with _opensearch_lock:
+        if pid not in _opensearch:
+            _opensearch.clear()
+            _opensearch[pid] = OpenSearch(
+                hosts=[{'host': OPENSEARCH_HOST, 'port': OPENSEARCH_PORT}],
+                http_compress=True,
+                http_auth=None,
+                use_ssl=False,
+                verify_certs=False,
+                ssl_assert_hostname=False,
+                ssl_show_warn=False,
+                connection_class=MeteredHttpConnection,
+                pool_maxsize=OPENSEARCH_POOL_SIZE,
+                timeout=OPENSEARCH_TIMEOUT
+            )
+        return _opensearch[pid]
 
 
 class OpenSearchClient:
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, pit_id=None, retry_budget=None):
         """
         Initialize an OpenSearchClient object.
 
-        This method creates an `OpenSearch` client object with settings from the config file.
+        This object only holds the query state. Connections come from the `OpenSearch` client shared by the whole
+        process, see `get_opensearch()`, so every job in a worker reuses the same warm connection pool.
+        If `pit_id` is provided, queries run against that point-in-time instead of the live index.
+        If `retry_budget` is provided, retries of failed searches are drawn from that budget shared by the run.
         """
-        self.opensearch_client = OpenSearch(
-            hosts=[{'host': OPENSEARCH_HOST, 'port': OPENSEARCH_PORT}],
-            http_compress=True,
-            http_auth=None,
-            use_ssl=False,
-            verify_certs=False,
-            ssl_assert_hostname=False,
-            ssl_show_warn=False,
-            connection_class=RequestsHttpConnection
-        )
-        # TODO: Configure a more generous default timeout
+        self.opensearch_client = get_opensearch()
         self.query = None
         self.logger = logger
+        self.pit_id = pit_id
+        self.retry_budget = retry_budget
+        self.stats = {}
+        self.ranges = None
+        self._stats_lock = threading.Lock()
 
         # Disable the logs about connections to the OpenSearch cluster and urllib3 debug messages
         logging.getLogger("opensearch").setLevel(logging.WARNING)
         logging.getLogger("urllib3").setLevel(logging.INFO)
         #logger.propagate = False
 
-    def return_all_results(self):
-        """Execute query and return all results as an iterator, using search_after"""
-        timeout_count = 0
-        failure_count = 0
+    def return_all_results(self, slices=1, raw=False, prefetch=PREFETCH_DEPTH):
+        """Execute query and return all results as an iterator, using search_after
+
+        See `return_all_pages()` for the arguments.
+        """
+        for page in self.return_all_pages(slices=slices, raw=raw, prefetch=prefetch):
+            yield from page.hits
+
+    def return_all_pages(self, slices=1, raw=False, prefetch=PREFETCH_DEPTH, ranges=None, positions=None):
+        """Execute query and return all results as an iterator of pages, using search_after
+
+        Each page carries the sort values of every hit and the index of the cursor that fetched it, so that a
+        caller can record how far each cursor has got and later resume from there. The ranges the cursors cover
+        are stored in `self.ranges`, and time spent waiting for each page is accumulated in `self.stats`.
+
+        Args:
+            slices (int): Number of concurrent `search_after` cursors to split the query into. Each cursor covers a
+                contiguous range of `updated` values, so results are yielded page by page in the order the cursors
+                return them rather than in strict sort order.
+            raw (bool): Yield the `_source` of each hit as a plain dictionary instead of an `opensearch_dsl` `Hit`.
+                This skips building the `Response` wrapper, and only `_source` and `sort` are sent back.
+            prefetch (int): Number of pages each cursor fetches ahead on a background thread while the caller is
+                still consuming earlier pages. 0 fetches each page only when the previous one is exhausted.
+            ranges (list): List of (gte, lt) ranges to use for the cursors instead of splitting the query into
+                `slices`, e.g. when resuming.
+            positions (dict): Sort values to resume each cursor after, keyed by cursor index.
+        """
+        if not self.query: self.build_query()
+        self.stats = {"pages": 0, "wait_time": 0.0, "retries": {}, "retry_sleep": 0.0}
+        positions = positions or {}
+
+        if ranges is None:
+            ranges = self.get_slice_ranges(slices) if slices > 1 else [(None, None)]
+        self.ranges = [tuple(r) for r in ranges]
+        if len(self.ranges) > 1:
+            self.logger.debug(f"Fetching {len(self.ranges)} slices: {self.ranges}")
+            pages = self._prefetched_pages(self.ranges, raw, max(prefetch, 1), positions)
+        elif prefetch > 0:
+            pages = self._prefetched_pages(self.ranges, raw, prefetch, positions)
+        else:
+            pages = self._cursor_pages(0, *self.ranges[0], raw=raw, search_after=positions.get(0))
+        yield from self._metered_pages(pages)
+
+    def return_cursor_pages(self, ranges=None, raw=False, prefetch=PREFETCH_DEPTH, positions=None):
+        """Execute query and return a separate iterator of pages for each `updated` range, using search_after
+
+        Unlike `return_all_pages()`, the pages of each cursor are kept apart, so that every iterator yields its hits
+        in sort order. Each cursor prefetches on its own thread, so the iterators can be consumed concurrently, see
+        `merge_slices()`. The ranges are stored in `self.ranges`, and time spent waiting for each page is
+        accumulated in `self.stats`.
+
+        Args:
+            ranges (list): List of (gte, lt) ranges, one per cursor, by default a single cursor over the whole query.
+            raw (bool): Fetch raw `_source` dictionaries, see `return_all_pages()`.
+            prefetch (int): Number of pages each cursor fetches ahead of the caller, 0 to fetch each page on demand.
+            positions (dict): Sort values to resume each cursor after, keyed by cursor index.
+
+        Returns:
+            list: An iterator of pages for each range, in the order of `ranges`.
+        """
         if not self.query: self.build_query()
+        self.stats = {"pages": 0, "wait_time": 0.0, "retries": {}, "retry_sleep": 0.0}
+        positions = positions or {}
+
+        self.ranges = [tuple(r) for r in ranges or [(None, None)]]
+        if len(self.ranges) > 1:
+            self.logger.debug(f"Fetching {len(self.ranges)} slices: {self.ranges}")
+        if prefetch > 0:
+            return [self._metered_pages(self._prefetched_pages([r], raw, prefetch, positions, cursors=[cursor]))
+                    for cursor, r in enumerate(self.ranges)]
+        return [self._metered_pages(self._cursor_pages(cursor, *r, raw=raw, search_after=positions.get(cursor)))
+                for cursor, r in enumerate(self.ranges)]
+
+    def _metered_pages(self, pages):
+        """Yield the pages of an iterator, counting them and the time spent waiting for each in `self.stats`"""
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                page = next(pages, None)
+                with self._stats_lock:
+                    self.stats["wait_time"] += time.perf_counter() - wait_start
+                    if page is not None:
+                        self.stats["pages"] += 1
+                if page is None:
+                    break
+                yield page
+        finally:
+            pages.close()
+
+    def _execute_page(self, query, raw=False):
+        """Execute a single page of a query
+
+        Returns:
+            tuple: (timed out, list of hits, list of sort values of each hit, took in milliseconds)
+        """
+        if raw:
+            response = self.opensearch_client.search(body=query.to_dict(),
+                                                     index=None if self.pit_id else OPENSEARCH_INDEX,
+                                                     filter_path=RAW_FILTER_PATH)
+            hits = response.get("hits", {}).get("hits", [])
+            return (response.get("timed_out", False), [hit["_source"] for hit in hits],
+                    [hit["sort"] for hit in hits], response.get("took"))
+
+        response = query.execute()
+        return response.timed_out, response.hits, [hit.meta.sort for hit in response.hits], response.took
+
+    def _cursor_pages(self, cursor, gte=None, lt=None, raw=False, search_after=None):
+        """Yield the pages of one cursor, covering the `updated` range [gte, lt) of the query"""
+        query = self.query
+        if gte or lt:
+            query = query.filter("range", updated=updated_range(gte, lt))
+        if search_after:
+            query = query.extra(search_after=search_after)
+        for hits, sorts in self._search_after_pages(query, raw):
+            yield Page(hits, sorts, cursor)
+
+    def _search_after_pages(self, query, raw=False):
+        """Execute a query and yield each page of hits with their sort values, using search_after
+
+        Failed and timed out requests are retried according to a `RetryPolicy`, whose counts are added to
+        `self.stats` when the cursor finishes.
+        """
         query_finished = False
+        page_size = AdaptivePageSize(logger=self.logger) if ADAPTIVE_PAGE_SIZE else None
+        retry = RetryPolicy(logger=self.logger, budget=self.retry_budget)
 
-        while not query_finished:
-            search_after = self.query.to_dict().get("search_after")
-            #self.logger.debug(f"Running query with `search_after`: {search_after}")
-            #self.logger.debug(f"Query: {self.query.to_dict()}")
-            try:
-                response = self.query.execute()
-                if not response.timed_out:
-                    # TODO: Check this actually triggers, Timeout exceptions might be unintentionally caught by the broad `except Exception`
-                    #       block below and therefore counting as a Failure rather than a timeout
-                    if len(response.hits) > 0:
-                        #if len(response.hits) < 1000:
-                            #self.logger.debug(f"LESS THAN 1K - Query returned {len(response.hits)} results")
-                        yield from response.hits
-                        self.query = self.query.extra(search_after=response.hits[-1].meta.sort)
-                    else:
-                        query_finished = True
+        try:
+            while not query_finished:
+                search_after = query.to_dict().get("search_after")
+                #self.logger.debug(f"Running query with `search_after`: {search_after}")
+                #self.logger.debug(f"Query: {query.to_dict()}")
+                if page_size:
+                    query = query.extra(size=page_size.size)
+                try:
+                    MeteredHttpConnection.last_response.size = None
+                    timed_out, hits, sorts, took = self._execute_page(query, raw)
+                except Exception as e:
+                    kind = classify_failure(e)
+                    if page_size and kind == "timeout":
+                        page_size.update(timed_out=True)
+                    retry.failed(kind, e)
+                    continue
+
+                if page_size:
+                    page_size.update(took=took, nbytes=MeteredHttpConnection.last_response.size, timed_out=timed_out)
+                if timed_out:
+                    self.logger.info(f"Query timed out (search_after: {search_after})")
+                    retry.failed("timeout")
+                    continue
+
+                retry.succeeded()
+                if len(hits) > 0:
+                    #if len(hits) < 1000:
+                        #self.logger.debug(f"LESS THAN 1K - Query returned {len(hits)} results")
+                    yield hits, sorts
+                    query = query.extra(search_after=sorts[-1])
                 else:
-                    timeout_count += 1
-                    self.logger.info(f"Query timed out (count: {timeout_count}): {self.query.to_dict}")
-                    if timeout_count > 10:
-                        self.logger.error("Too many timeouts, giving up")
-                        raise TooManyTimeouts
-                    else:
-                        self.logger.warning("Timeout, sleeping for 10 seconds and retrying")
-                        time.sleep(10)
+                    query_finished = True
+        finally:
+            with self._stats_lock:
+                retries = self.stats.setdefault("retries", {})
+                for kind, count in retry.retries.items():
+                    retries[kind] = retries.get(kind, 0) + count
+                self.stats["retry_sleep"] = self.stats.get("retry_sleep", 0.0) + retry.sleep_time
+
+    def _prefetched_pages(self, ranges, raw=False, depth=1, positions=None, cursors=None):
+        """Fetch pages on background threads, one `search_after` cursor per `updated` range
+
+        Each cursor runs the sequential `search_after` loop on its own thread, so the next request is already in
+        flight while the caller works through the current page. Pages are handed back through a queue bounded at
+        `depth` pages per cursor.
+
+        Args:
+            ranges (list): List of (gte, lt) tuples, with None for an open end.
+            raw (bool): Fetch raw `_source` dictionaries, see `return_all_results()`.
+            depth (int): Number of pages each cursor may fetch ahead of the caller.
+            positions (dict): Sort values to resume each cursor after, keyed by cursor index.
+            cursors (list): Index of the cursor for each range, by default its position in `ranges`.
+        """
+        positions = positions or {}
+        cursors = cursors or range(len(ranges))
+        pages = Queue(maxsize=len(ranges) * depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def fetch_range(cursor, gte, lt):
+            try:
+                for page in self._cursor_pages(cursor, gte, lt, raw, positions.get(cursor)):
+                    if not put(page):
+                        return
+                put(None)
             except Exception as e:
-                failure_count += 1
-                if failure_count > 10:
-                    self.logger.error("Too many failures, giving up")
-                    raise TooManyFailures
+                put(e)
+
+        threads = [threading.Thread(target=fetch_range, args=(cursor, *r), daemon=True) for cursor, r in zip(cursors, ranges)]
+        for t in threads:
+            t.start()
+
+        try:
+            remaining = len(threads)
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
                 else:
-                    self.logger.warning("Failure, sleeping for 10 seconds and retrying")
-                    self.logger.error(f"Error message: {e}")
-                    time.sleep(10)
+                    yield page
+        finally:
+            stop.set()
+
+    def get_slice_ranges(self, slices):
+        """Split the current query into contiguous `updated` ranges holding roughly equal numbers of records
+
+        An hourly `date_histogram` over the query is used to place the boundaries. The first and last ranges are
+        left open so that the ranges always cover the whole query, whatever the histogram returns.
+
+        Args:
+            slices (int): Maximum number of ranges to return.
+
+        Returns:
+            list: List of (gte, lt) tuples of ISO timestamps, with None for an open end.
+        """
+        buckets = self.get_histogram('1h')
+
+        total = sum(count for _, count in buckets)
+        target = total / slices if slices else total
+        boundaries = []
+        running = 0
+        for key, count in buckets:
+            if running >= target * (len(boundaries) + 1) and len(boundaries) < slices - 1:
+                boundaries.append(key)
+            running += count
+
+        edges = [None] + boundaries + [None]
+        return list(zip(edges[:-1], edges[1:]))
+
+    def get_histogram(self, interval):
+        """Count the records matched by the current query per `updated` interval
 
-    def build_query(self):
-        """Build a basic query to match all findable or registered DataCite DOIs"""
-        s = Search(using=self.opensearch_client, index=OPENSEARCH_INDEX)
+        Args:
+            interval (str): Fixed interval of the histogram buckets, e.g. `1d` or `1h`.
+
+        Returns:
+            list: List of (bucket start as an ISO timestamp, doc count) tuples, skipping empty buckets.
+        """
+        if not self.query: self.build_query()
+        agg_query = self.query.extra(track_total_hits=False, size=0)
+        agg_query.aggs.bucket('updated', 'date_histogram', field='updated', fixed_interval=interval,
+                              min_doc_count=1, format="yyyy-MM-dd'T'HH:mm:ss'Z'")
+        return [(b.key_as_string, b.doc_count) for b in agg_query.execute().aggregations.updated.buckets]
+
+    def create_pit(self):
+        """Open a point-in-time on the index so later queries all see the same snapshot
+
+        Returns:
+            str: The point-in-time ID.
+        """
+        response = self.opensearch_client.create_pit(index=OPENSEARCH_INDEX, params={"keep_alive": PIT_KEEP_ALIVE})
+        self.pit_id = response["pit_id"]
+        return self.pit_id
+
+    def refresh_pit(self):
+        """Extend the keep-alive of the point-in-time by running an empty search against it"""
+        if not self.pit_id:
+            return
+        self.opensearch_client.search(body={"size": 0, "track_total_hits": False,
+                                            "pit": {"id": self.pit_id, "keep_alive": PIT_KEEP_ALIVE}})
+
+    def delete_pit(self):
+        """Close the point-in-time, releasing the resources held for it on the cluster"""
+        if not self.pit_id:
+            return
+        self.opensearch_client.delete_pit(body={"pit_id": [self.pit_id]})
+        self.pit_id = None
+
+    def build_query(self, states=("findable", "registered")):
+        """Build a basic query to match all DataCite DOIs in the given states, by default findable or registered"""
+        if self.pit_id:
+            # Searches against a point-in-time must not name an index
+            s = Search(using=self.opensearch_client)
+            s = s.extra(pit={"id": self.pit_id, "keep_alive": PIT_KEEP_ALIVE})
+        else:
+            s = Search(using=self.opensearch_client, index=OPENSEARCH_INDEX)
         s = s.filter("terms", agency=["DataCite", "datacite"])
-        s = s.filter("terms", aasm_state=["findable", "registered"])
+        s = s.filter("terms", aasm_state=list(states))
         #s = s.filter("range", updated={"lte": "2020-01-01T00:00:00Z"})  #TEMP for testing
         s = s.query()  # This adds a simple match_all
         s = s.sort("updated", "uid")
-        s = s.extra(track_total_hits=False, size=1000)
+        s = s.extra(track_total_hits=False, size=PAGE_SIZE)
         self.query = s
 
 
-    def filter_fields(self):
-        """Add filters to the query object to limit results to specific fields"""
-        field_list = [
+    def filter_fields(self, field_list=None):
+        """Add filters to the query object to limit results to specific fields, by default all those in the JSONL"""
+        field_list = field_list or [
             "uid",
             "prefix",
             "suffix",
@@ -153,6 +458,118 @@ class OpenSearchClient:
     def add_month_filter(self, year, month):
         """Add a filter to the query object to limit results to records updated in a certain year and month"""
         if not self.query: self.build_query()
-        self.query = self.query.filter("range", updated={"gte": f"{year}-{month:02d}-01T00:00:00Z",
-                                                         "lte": f"{year}-{month:02d}-{calendar.monthrange(year, month)[1]}"
-                                                         f"T23:59:59Z"})
\ No newline at end of file
+        self.query = self.query.filter("range", updated=month_range(year, month))
+
+    def add_range_filter(self, gte=None, lt=None):
+        """Add a filter to the query object to limit results to records updated within a half-open range"""
+        if not self.query: self.build_query()
+        if gte or lt:
+            self.query = self.query.filter("range", updated=updated_range(gte, lt))
+
+
+def merge_pages(streams):
+    """Merge the pages of several `return_all_pages()` iterators into a single iterator of hits in sort order
+
+    Each iterator must yield its hits in sort order, which holds for queries fetched without slices, and for each
+    iterator from `return_cursor_pages()`.
+
+    Args:
+        streams (dict): Page iterators keyed by stream name.
+
+    Yields:
+        tuple: (stream name, cursor index, sort values, hit)
+    """
+    def stream_hits(name, pages):
+        for page in pages:
+            for hit, sort in zip(page.hits, page.sorts):
+                yield sort, name, page.cursor, hit
+
+    for sort, name, cursor, hit in heapq.merge(*(stream_hits(name, pages) for name, pages in streams.items()),
+                                               key=itemgetter(0)):
+        yield name, cursor, sort, hit
+
+
+def merge_slices(streams, depth=PREFETCH_DEPTH, chunk_size=500):
+    """Merge the streams of each slice into sort order, and fan the slices in as their hits are merged
+
+    Every stream must be split into the same `updated` ranges, so that the hits of one slice of each stream can be
+    merged with `merge_pages()`. With several slices, each one is merged on its own thread, so the slices are fetched
+    concurrently and their hits come interleaved in chunks, in sort order within each slice only.
+
+    Args:
+        streams (dict): Lists of page iterators, one per slice, keyed by stream name, e.g. from
+            `return_cursor_pages()`.
+        depth (int): Number of chunks of hits each slice may merge ahead of the caller.
+        chunk_size (int): Number of hits each slice hands over at a time.
+
+    Yields:
+        tuple: (stream name, cursor index, sort values, hit)
+    """
+    slice_count = len(next(iter(streams.values())))
+    slices = [{name: pages[i] for name, pages in streams.items()} for i in range(slice_count)]
+    if slice_count == 1:
+        yield from merge_pages(slices[0])
+        return
+
+    chunks = Queue(maxsize=slice_count * max(depth, 1))
+    stop = threading.Event()
+    # The first error of any slice, raised ahead of the chunks still queued by the others
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def merge_slice(slice_streams):
+        try:
+            chunk = []
+            for hit in merge_pages(slice_streams):
+                chunk.append(hit)
+                if len(chunk) >= chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if not chunk or put(chunk):
+                put(None)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for pages in slice_streams.values():
+                pages.close()
+
+    threads = [threading.Thread(target=merge_slice, args=(slice_streams,), daemon=True) for slice_streams in slices]
+    for t in threads:
+        t.start()
+
+    try:
+        remaining = len(threads)
+        while remaining:
+            if errors:
+                raise errors[0]
+            try:
+                chunk = chunks.get(timeout=1)
+            except Empty:
+                continue
+            if chunk is None:
+                remaining -= 1
+            else:
+                yield from chunk
+    finally:
+        stop.set()
+
+
+def month_range(year, month):
+    """Build the body of a range filter on `updated` covering a whole month"""
+    return {"gte": f"{year}-{month:02d}-01T00:00:00Z",
+            "lte": f"{year}-{month:02d}-{calendar.monthrange(year, month)[1]}T23:59:59Z"}
+
+
+def updated_range(gte=None, lt=None):
+    """Build the body of a range filter on `updated`, leaving out any open end"""
+    return {k: v for k, v in (("gte", gte), ("lt", lt)) if v}
@@ -0,0 +1,64 @@
+from .config import PAGE_SIZE, PAGE_SIZE_MIN, PAGE_SIZE_MAX, PAGE_TARGET_TOOK, PAGE_MAX_BYTES
+
+
+class AdaptivePageSize:
+    def __init__(self, logger=None, size=PAGE_SIZE, min_size=PAGE_SIZE_MIN, max_size=PAGE_SIZE_MAX,
+                 target_took=PAGE_TARGET_TOOK, max_bytes=PAGE_MAX_BYTES):
+        """
+        Initialize an AdaptivePageSize object.
+
+        Tracks the `size` of a `search_after` cursor, shrinking it when pages are slow, too large or time out,
+        and growing it when pages come back quickly and small. Between the two, the size is left alone so that
+        it settles rather than oscillating.
+
+        Args:
+            logger: Logger used to report every change of size.
+            size (int): Initial page size.
+            min_size (int): Smallest page size.
+            max_size (int): Largest page size.
+            target_took (int): Target server-side `took` per page, in milliseconds.
+            max_bytes (int): Largest acceptable response body, in bytes.
+        """
+        self.logger = logger
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_took = target_took
+        self.max_bytes = max_bytes
+        self.size = self._clamp(size)
+
+    def _clamp(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def update(self, took=None, nbytes=None, timed_out=False):
+        """Adjust the page size from the outcome of the last request
+
+        Args:
+            took (int): Server-side `took` of the response, in milliseconds.
+            nbytes (int): Size of the response body, in bytes.
+            timed_out (bool): Whether the request timed out.
+
+        Returns:
+            int: The page size to use for the next request.
+        """
+        old_size = self.size
+        if timed_out:
+            self.size = self._clamp(self.size // 2)
+            reason = "request timed out"
+        elif (nbytes and nbytes > self.max_bytes) or (took and took > self.target_took * 2):
+            # Shrink to the size expected to bring the page back within both limits
+            factor = min(self.max_bytes / nbytes if nbytes else 1, self.target_took / took if took else 1)
+            self.size = self._clamp(self.size * factor)
+            reason = f"took {took}ms, {nbytes} bytes"
+        elif (not nbytes or nbytes < self.max_bytes / 2) and (took is None or took < self.target_took / 2):
+            # Grow by up to 50%, without projecting past the byte limit
+            factor = 1.5
+            if nbytes:
+                factor = min(factor, self.max_bytes / 2 / nbytes)
+            self.size = self._clamp(self.size * max(factor, 1))
+            reason = f"took {took}ms, {nbytes} bytes"
+        else:
+            return self.size
+
+        if self.size != old_size and self.logger:
+            self.logger.info(f"Page size {old_size} -> {self.size} ({reason})")
+        return self.size
@@ -0,0 +1,23 @@
+import json
+import os
+
+
+def part_counts_path(output_dir: str, file_prefix: str = "") -> str:
+    """Return the path of the file listing the record counts of the files written by a job to `output_dir`"""
+    return f"{output_dir}/.{file_prefix}parts.json"
+
+
+def load_part_counts(path: str) -> dict:
+    """Load the record counts of a month's files, keyed by file name, or an empty dict if there are none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_part_counts(path: str, counts: dict) -> None:
+    """Store the record counts of a month's files, replacing any earlier ones atomically"""
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(counts, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
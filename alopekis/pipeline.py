@@ -0,0 +1,114 @@
+import threading
+import time
+from queue import Queue, Empty, Full
+
+from .config import PIPELINE_DEPTH
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class PipelineStage:
+    def __init__(self, name, items, upstream=None, depth=PIPELINE_DEPTH):
+        """
+        Initialize a PipelineStage object.
+
+        The stage runs the `items` iterator on a background thread and hands each item to the consumer through a
+        queue bounded at `depth` items, so that it works ahead of the consumer until the queue is full. Exceptions
+        raised by the iterator, or passed to `cancel()`, are re-raised to the consumer. Stages are chained by building the iterator of one
+        stage from another stage.
+
+        Args:
+            name (str): Name of the stage, used when reporting its stats.
+            items: Iterator producing the output of the stage.
+            upstream (PipelineStage): Stage the iterator consumes, if any, so that time spent waiting for it is
+                not counted as busy time.
+            depth (int): Number of items that may wait between this stage and its consumer.
+        """
+        self.name = name
+        self.items = items
+        self.upstream = upstream
+        self.queue = Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=f"pipeline-{name}", daemon=True)
+        self.elapsed = 0.0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.depth_total = 0
+        self.depth_samples = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            for item in self.items:
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except Exception as e:
+            self._put(e)
+        finally:
+            close = getattr(self.items, "close", None)
+            if close:
+                close()
+            self.elapsed = time.perf_counter() - start
+
+    def _put(self, item):
+        wait_start = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+        finally:
+            self.put_wait += time.perf_counter() - wait_start
+
+    def __iter__(self):
+        while True:
+            if self.error is not None:
+                raise self.error
+            self.depth_total += self.queue.qsize()
+            self.depth_samples += 1
+            wait_start = time.perf_counter()
+            try:
+                item = self.queue.get(timeout=1)
+            except Empty:
+                if self.error is not None:
+                    raise self.error
+                if self.stop.is_set():
+                    return
+                continue
+            finally:
+                self.get_wait += time.perf_counter() - wait_start
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop the stage, letting its thread exit even if the consumer did not read all of its output"""
+        self.stop.set()
+
+    def cancel(self, error: Exception):
+        """Stop the stage and raise `error` to the consumer within a second, even if the iterator is stuck"""
+        self.error = error
+        self.stop.set()
+
+    @property
+    def busy(self):
+        """Time the stage spent working, excluding waits on its upstream stage and on its consumer"""
+        upstream_wait = self.upstream.get_wait if self.upstream else 0.0
+        return max(self.elapsed - self.put_wait - upstream_wait, 0.0)
+
+    @property
+    def mean_depth(self):
+        """Mean number of items waiting in the queue whenever the consumer asked for the next one"""
+        return self.depth_total / self.depth_samples if self.depth_samples else 0.0
@@ -0,0 +1,96 @@
+import random
+import time
+
+from opensearchpy.exceptions import ConnectionError, ConnectionTimeout, TransportError
+from .config import RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_FAILURES, RETRY_MAX_TIMEOUTS
+from .exceptions import TooManyFailures, TooManyTimeouts
+
+# Multiplier on the base delay for each kind of failure. The cluster asked us to back off for 429s and 503s,
+# while a reset connection is usually fixed by simply reconnecting.
+BACKOFF_MULTIPLIERS = {
+    "throttled": 4,
+    "unavailable": 4,
+    "timeout": 2,
+    "connection": 0.5,
+    "failure": 1,
+}
+
+
+def classify_failure(e: Exception) -> str:
+    """Return the kind of failure an exception raised by a search represents"""
+    if isinstance(e, ConnectionTimeout):
+        return "timeout"
+    if isinstance(e, ConnectionError):
+        return "connection"
+    if isinstance(e, TransportError):
+        if e.status_code == 429:
+            return "throttled"
+        if e.status_code == 503:
+            return "unavailable"
+    return "failure"
+
+
+class RetryPolicy:
+    def __init__(self, logger=None, budget=None, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 max_failures=RETRY_MAX_FAILURES, max_timeouts=RETRY_MAX_TIMEOUTS):
+        """
+        Initialize a RetryPolicy object for a single `search_after` cursor.
+
+        Sleeps between retries use exponential backoff with full jitter, so workers that fail together do not
+        retry together. The delay grows with the number of consecutive failures and resets after a success.
+
+        Args:
+            logger: Logger for retry messages.
+            budget (multiprocessing.Value): Retries left for the whole run, shared between all workers. None for
+                no shared limit.
+            base_delay (float): Delay before the first retry, in seconds, before the multiplier for the failure kind.
+            max_delay (float): Longest delay between retries, in seconds.
+            max_failures (int): Failures of any kind other than timeouts tolerated by the cursor.
+            max_timeouts (int): Timeouts tolerated by the cursor.
+        """
+        self.logger = logger
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_failures = max_failures
+        self.max_timeouts = max_timeouts
+        self.consecutive = 0
+        self.retries = {}
+        self.sleep_time = 0.0
+
+    def succeeded(self):
+        """Record a successful request, resetting the backoff"""
+        self.consecutive = 0
+
+    def failed(self, kind: str, error=None) -> None:
+        """Record a failed request and sleep before the retry
+
+        Raises:
+            TooManyTimeouts: The cursor has used up its timeouts.
+            TooManyFailures: The cursor has used up its other failures, or the run has used up its retry budget.
+        """
+        self.retries[kind] = self.retries.get(kind, 0) + 1
+        self.consecutive += 1
+        timeouts = self.retries.get("timeout", 0)
+        failures = sum(self.retries.values()) - timeouts
+
+        if kind == "timeout" and timeouts > self.max_timeouts:
+            self.logger.error("Too many timeouts, giving up")
+            raise TooManyTimeouts
+        if kind != "timeout" and failures > self.max_failures:
+            self.logger.error("Too many failures, giving up")
+            raise TooManyFailures
+        if self.budget is not None:
+            with self.budget.get_lock():
+                if self.budget.value <= 0:
+                    self.logger.error("Retry budget for the run is exhausted, giving up")
+                    raise TooManyTimeouts if kind == "timeout" else TooManyFailures
+                self.budget.value -= 1
+
+        ceiling = self.base_delay * BACKOFF_MULTIPLIERS.get(kind, 1) * 2 ** (self.consecutive - 1)
+        delay = random.uniform(0, min(self.max_delay, ceiling))
+        self.logger.warning(f"Search failed ({kind}, attempt {self.consecutive}), sleeping for {delay:.1f} seconds and retrying")
+        if error is not None:
+            self.logger.error(f"Error message: {error}")
+        time.sleep(delay)
+        self.sleep_time += delay
@@ -1,13 +1,33 @@
+import io
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from glob import glob
 from typing import List, Iterator, Iterable
 import boto3
 from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from .compression import Codec
+from .config import OUTPUT_PATH, UPLOAD_THREADS, S3_PART_SIZE, S3_ENDPOINT_URL
 
 logger = logging.getLogger("main")
 logger.propagate = False
 
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Return the S3 client of the current process, creating it on first use"""
+    global _client, _client_pid
+    with _client_lock:
+        if _client_pid != os.getpid():
+            _client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+            _client_pid = os.getpid()
+        return _client
+
 
 def empty_bucket(bucket: str) -> None:
     """Remove all the objects from the specified bucket.
@@ -15,14 +35,14 @@ def empty_bucket(bucket: str) -> None:
     Args:
         bucket (str): The name of the bucket to empty.
     """
-    s3 = boto3.resource('s3')
+    s3 = boto3.resource('s3', endpoint_url=S3_ENDPOINT_URL)
     bucket = s3.Bucket(bucket)
     
     # Delete all objects in the bucket
     bucket.objects.all().delete()
 
 
-def put_files(files: Iterable[str], bucket: str, extra_args: dict, root_dir=None) -> List[tuple]:
+def put_files(files: Iterable[str], bucket: str, extra_args: dict, root_dir=None, prefix: str = "") -> List[tuple]:
     """Put the specified files in the specified S3 bucket.
     
     Args:
@@ -30,11 +50,13 @@ def put_files(files: Iterable[str], bucket: str, extra_args: dict, root_dir=None
         bucket (str): The target S3 bucket name.
         extra_args (dict): Dictionary of extra arguments to pass to the S3 call.
         root_dir (str): The root directory that all filenames are relative to
+        prefix (str): Prefix added to the filenames to make their keys, e.g. to stage them.
         
     Returns:
         List[tuple]: A list of tuples containing (file_path, success, message) for each file
     """
-    s3_client = boto3.client('s3')
+    # Creating clients from the default session isn't thread-safe, and MonthUploader calls this from several threads
+    s3_client = get_s3_client()
     results = []
     
     for filename in files:
@@ -50,12 +72,12 @@ def put_files(files: Iterable[str], bucket: str, extra_args: dict, root_dir=None
             s3_client.upload_file(
                 Filename=file_path,
                 Bucket=bucket,
-                Key=filename,
+                Key=prefix + filename,
                 ExtraArgs=extra_args,
                 Config=TransferConfig(max_concurrency=32)
             )
             results.append((file_path, True, "Successfully uploaded"))
-            logger.debug(f"Uploaded {file_path} to {bucket}/{file_path}")
+            logger.debug(f"Uploaded {file_path} to {bucket}/{prefix}{filename}")
             
         except ClientError as e:
             error_msg = f"Failed to upload {file_path}: {str(e)}"
@@ -63,3 +85,332 @@ def put_files(files: Iterable[str], bucket: str, extra_args: dict, root_dir=None
             results.append((file_path, False, error_msg))
     
     return results
+
+
+def empty_prefix(bucket: str, prefix: str) -> None:
+    """Remove all the objects under a prefix from the specified bucket, and abort their incomplete uploads.
+
+    Args:
+        bucket (str): The name of the bucket to clean up.
+        prefix (str): The prefix of the keys to remove.
+    """
+    s3 = boto3.resource('s3', endpoint_url=S3_ENDPOINT_URL)
+    s3.Bucket(bucket).objects.filter(Prefix=prefix).delete()
+    abort_incomplete_uploads(bucket, prefix)
+
+
+def publish_objects(bucket: str, keys: Iterable[str], prefix: str, content_type: str = None,
+                    threads: int = UPLOAD_THREADS) -> List[str]:
+    """Copy staged objects over the published data file, from `prefix` + key to key, within the bucket.
+
+    Args:
+        bucket (str): The bucket the objects were staged in.
+        keys (Iterable[str]): The keys to publish, without the prefix.
+        prefix (str): The prefix the objects were staged under.
+        content_type (str): ContentType of the published objects.
+        threads (int): Number of objects copied at once.
+
+    Returns:
+        List[str]: The keys that failed to copy.
+    """
+    client = get_s3_client()
+    extra_args = {'ContentType': content_type, 'MetadataDirective': 'REPLACE'} if content_type else {}
+
+    def copy(key: str) -> bool:
+        try:
+            # Managed copy, so that objects above the 5 GB limit of a single copy are copied in parts
+            client.copy(CopySource={'Bucket': bucket, 'Key': prefix + key}, Bucket=bucket, Key=key,
+                        ExtraArgs=extra_args, Config=TransferConfig(max_concurrency=8))
+            return True
+        except ClientError as e:
+            logger.error(f"Failed to publish {bucket}/{prefix}{key}: {e}")
+            return False
+
+    keys = list(keys)
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="publish") as executor:
+        return [key for key, copied in zip(keys, executor.map(copy, keys)) if not copied]
+
+
+def delete_stale_objects(bucket: str, keep: Iterable[str]) -> int:
+    """Remove every object from the specified bucket whose key is not in `keep`.
+
+    Args:
+        bucket (str): The name of the bucket to clean up.
+        keep (Iterable[str]): The keys to keep.
+
+    Returns:
+        int: The number of objects removed.
+    """
+    keep = set(keep)
+    s3 = boto3.resource('s3', endpoint_url=S3_ENDPOINT_URL)
+    bucket = s3.Bucket(bucket)
+    stale = [{'Key': obj.key} for obj in bucket.objects.all() if obj.key not in keep]
+
+    # delete_objects takes at most 1000 keys per call
+    for i in range(0, len(stale), 1000):
+        bucket.delete_objects(Delete={'Objects': stale[i:i + 1000], 'Quiet': True})
+    return len(stale)
+
+
+def abort_incomplete_uploads(bucket: str, prefix: str = "") -> int:
+    """Abort the multipart uploads left incomplete in the specified bucket, e.g. by a worker that died.
+
+    Args:
+        bucket (str): The name of the bucket to clean up.
+        prefix (str): Only abort uploads of keys starting with this prefix.
+
+    Returns:
+        int: The number of uploads aborted.
+    """
+    client = get_s3_client()
+    aborted = 0
+    for page in client.get_paginator('list_multipart_uploads').paginate(Bucket=bucket, Prefix=prefix):
+        for upload in page.get('Uploads', []):
+            client.abort_multipart_upload(Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+            aborted += 1
+    return aborted
+
+
+class MonthUploader:
+    def __init__(self, bucket: str, extension: str, content_type: str, threads: int = UPLOAD_THREADS,
+                 root_dir: str = OUTPUT_PATH, prefix: str = ""):
+        """
+        Initialize a MonthUploader object.
+
+        Uploads the files of finished months on a thread pool while the rest of the data file is still being
+        generated. Uploads of the same month run one at a time in the order they were requested, and an upload is
+        skipped if another one of the same month was requested before it started, so the last upload of a month
+        that is regenerated always wins.
+
+        With the s3 output backend, the month's objects are already in the bucket, and the uploader merges the
+        objects of split months instead, see `merge_month()`.
+
+        Args:
+            bucket (str): The target S3 bucket name.
+            extension (str): File extension of the output codec, e.g. `.gz`.
+            content_type (str): ContentType of the output files.
+            threads (int): Number of months uploaded at once.
+            root_dir (str): The root directory of the data file, which keys are relative to.
+            prefix (str): Prefix of the keys the files are uploaded to, and the merged objects written to.
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+        self.extension = extension
+        self.content_type = content_type
+        self.root_dir = root_dir
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="upload")
+        self.lock = threading.Lock()
+        self.month_locks = {}
+        self.versions = {}
+        self.failed = {}
+        self.merges = []
+
+    def upload_month(self, year: int, month: int) -> None:
+        """Queue the files of a month for upload, replacing any earlier upload of the month"""
+        key = f"{year}-{month:02d}"
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            month_lock = self.month_locks.setdefault(key, threading.Lock())
+            version = self.versions[key]
+        self.executor.submit(self._upload, key, version, month_lock)
+
+    def _upload(self, key: str, version: int, month_lock: threading.Lock) -> None:
+        with month_lock:
+            with self.lock:
+                if self.versions[key] != version:
+                    # The month was regenerated, its latest upload will follow
+                    return
+            files = glob(f'dois/updated_{key}/*{self.extension}', root_dir=self.root_dir)
+            logger.info(f"Uploading {len(files)} files for {key}")
+            try:
+                results = put_files(files=files, bucket=self.bucket, extra_args={'ContentType': self.content_type},
+                                    root_dir=self.root_dir, prefix=self.prefix)
+                failed = [os.path.relpath(path, self.root_dir) for path, success, _ in results if not success]
+            except Exception as e:
+                logger.error(f"Failed to upload {key}: {e}")
+                failed = files
+            with self.lock:
+                if failed:
+                    self.failed[key] = failed
+                else:
+                    self.failed.pop(key, None)
+
+    def merge_month(self, year: int, month: int, job_objects: List[List[dict]], codec: Codec, objects: dict) -> None:
+        """Queue the merge of the objects of a split month, see `merge_month_objects()`
+
+        The merged objects are stored in `objects` under `YYYY-M`, the key of the month's results, once the merge
+        is done.
+        """
+        key = f"{year}-{month:02d}"
+        with self.lock:
+            month_lock = self.month_locks.setdefault(key, threading.Lock())
+            self.merges.append(self.executor.submit(self._merge, year, month, job_objects, codec, objects, month_lock))
+
+    def _merge(self, year: int, month: int, job_objects: List[List[dict]], codec: Codec, objects: dict,
+               month_lock: threading.Lock) -> None:
+        key = f"{year}-{month:02d}"
+        with month_lock:
+            logger.info(f"Merging the objects of {len(job_objects)} jobs for {key}")
+            try:
+                merged = merge_month_objects(self.bucket, year, month, job_objects, codec, self.prefix)
+            except Exception as e:
+                logger.error(f"Failed to merge {key}: {e}")
+                with self.lock:
+                    self.failed[key] = [obj['key'] for objs in job_objects for obj in objs]
+                return
+            with self.lock:
+                objects[f"{year}-{month}"] = merged
+                self.failed.pop(key, None)
+
+    def wait_merges(self) -> None:
+        """Wait for every queued merge to finish, before the jobs of a merged month may run again"""
+        with self.lock:
+            merges = list(self.merges)
+        wait(merges)
+
+    def finish(self) -> List[str]:
+        """Wait for every queued upload and merge to finish
+
+        Returns:
+            List[str]: The files that failed to upload, relative to `root_dir`, or the objects of the months that
+                failed to merge.
+        """
+        self.executor.shutdown(wait=True)
+        return [file for files in self.failed.values() for file in files]
+
+
+class S3MultipartFile(io.BufferedIOBase):
+    def __init__(self, bucket: str, key: str, content_type: str = None, part_size: int = S3_PART_SIZE):
+        """
+        Initialize an S3MultipartFile object.
+
+        A binary file that streams what is written to it into an S3 object, so output never touches the local disk.
+        Data is collected until `part_size` bytes are waiting and then sent as one part of a multipart upload, so
+        at most one part is held in memory. Closing the file uploads the rest and completes the object, which only
+        becomes visible then. An object smaller than one part is sent with a single PUT instead.
+
+        Args:
+            bucket (str): The target S3 bucket name.
+            key (str): Key of the object to write.
+            content_type (str): ContentType of the object.
+            part_size (int): Size of the parts of the upload, in bytes, at least 5 MB.
+        """
+        super().__init__()
+        self.client = get_s3_client()
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = {'ContentType': content_type} if content_type else {}
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+    def _upload_part(self, data: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                 **self.extra_args)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=data)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        """Upload whatever is still buffered and complete the object"""
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.extra_args)
+            else:
+                if self.buffer:
+                    self._upload_part(bytes(self.buffer))
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                      MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        """Discard the upload, leaving no object behind"""
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except ClientError as e:
+                logger.warning(f"Failed to abort upload of {self.bucket}/{self.key}: {e}")
+            self.upload_id = None
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't publish a partial object when the block writing it fails
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def merge_month_objects(bucket: str, year: int, month: int, job_objects: List[List[dict]], codec: Codec,
+                        prefix: str = "") -> List[dict]:
+    """Merge the objects of a month that was split into several jobs, the S3 counterpart of `finalize_month()`
+
+    The JSONL parts of every job are copied within the bucket to one contiguous `part_XXXX.jsonl.gz` sequence, and
+    the CSV pieces are streamed through an `S3MultipartFile` into the month CSV, after which the job objects are
+    removed.
+
+    Args:
+        bucket (str): The bucket the objects were written to.
+        year (int): Year of the month.
+        month (int): Month of the month.
+        job_objects (List[List[dict]]): The objects written by each job, in job order, as dicts of `key`, `size`
+            and `count`.
+        codec (Codec): Compression codec of the objects.
+        prefix (str): Prefix of the keys of the data file the month's objects are in.
+
+    Returns:
+        List[dict]: The merged objects of the month.
+    """
+    client = get_s3_client()
+    month_prefix = f"{prefix}dois/updated_{year}-{month:02d}"
+    csv_name = f"{year}-{month:02d}.csv{codec.extension}"
+    merged = []
+    csv_pieces = []
+    for objects in job_objects:
+        for obj in sorted(objects, key=lambda obj: obj['key']):
+            if obj['key'].endswith(csv_name):
+                csv_pieces.append(obj)
+                continue
+            key = f"{month_prefix}/part_{len(merged):04d}.jsonl{codec.extension}"
+            client.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': bucket, 'Key': obj['key']},
+                               ContentType=codec.content_type, MetadataDirective='REPLACE')
+            client.delete_object(Bucket=bucket, Key=obj['key'])
+            merged.append({**obj, 'key': key})
+
+    with S3MultipartFile(bucket, f"{month_prefix}/{csv_name}", content_type=codec.content_type) as csv_file:
+        for piece in csv_pieces:
+            body = client.get_object(Bucket=bucket, Key=piece['key'])['Body']
+            for chunk in body.iter_chunks(1024 * 1024):
+                csv_file.write(chunk)
+    for piece in csv_pieces:
+        client.delete_object(Bucket=bucket, Key=piece['key'])
+    merged.append({'key': csv_file.key, 'size': csv_file.size, 'count': sum(piece['count'] for piece in csv_pieces)})
+    return merged
@@ -0,0 +1,115 @@
+import heapq
+import json
+import os
+import threading
+import time
+
+from .config import DEFAULT_SECONDS_PER_RECORD, OUTPUT_PATH
+from .incremental import month_key
+
+RUNTIMES_FILE = "RUNTIMES.json"
+
+
+def load_runtimes() -> dict:
+    """Load the seconds per record of each month measured by earlier runs, or an empty dict if there are none"""
+    try:
+        with open(f"{OUTPUT_PATH}/{RUNTIMES_FILE}") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_runtimes(runtimes: dict) -> None:
+    """Store the seconds per record of each month for the next run"""
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    with open(f"{OUTPUT_PATH}/{RUNTIMES_FILE}.tmp", "w") as f:
+        json.dump(runtimes, f, indent=1, sort_keys=True)
+    os.replace(f"{OUTPUT_PATH}/{RUNTIMES_FILE}.tmp", f"{OUTPUT_PATH}/{RUNTIMES_FILE}")
+
+
+def lpt_makespan(durations: list, worker_count: int) -> float:
+    """Return the time a pool of `worker_count` workers takes to run jobs of `durations` in the given order, each
+    job going to the worker that is free first"""
+    loads = [0.0] * max(worker_count, 1)
+    for duration in durations:
+        heapq.heapreplace(loads, loads[0] + duration)
+    return max(loads)
+
+
+class JobScheduler:
+    def __init__(self, worker_count: int, runtimes: dict = None, default_rate: float = DEFAULT_SECONDS_PER_RECORD):
+        """
+        Initialize a JobScheduler object.
+
+        Orders jobs longest first, so the largest months start early instead of ending the run with a long tail
+        on a single worker. A job's duration is predicted from its expected count and the seconds per record its
+        month took in earlier runs, or the mean over every month if it has no history of its own. Without any
+        history, every month is predicted at `default_rate`.
+
+        Every batch of jobs is queued while the pool is idle, at startup and for each round of reruns, so the
+        predicted makespan of the run is the sum of the makespans of its batches. Each batch's makespan is fixed
+        when it is queued, before any of its jobs has run.
+
+        Args:
+            worker_count (int): Number of workers the jobs are shared between.
+            runtimes (dict): Seconds per record of each month from earlier runs, keyed by `month_key()`.
+            default_rate (float): Seconds per record of every month when there are no runtimes.
+        """
+        self.worker_count = worker_count
+        self.runtimes = dict(runtimes or {})
+        self.mean_rate = sum(self.runtimes.values()) / len(self.runtimes) if self.runtimes else default_rate
+        self.lock = threading.Lock()
+        # Predicted makespan of each batch, in seconds
+        self.batches = []
+        # Seconds and records measured for each month in this run
+        self.measured = {}
+        self.started = None
+        self.finished = None
+
+    def seconds_per_record(self, year: int, month: int) -> float:
+        """Return the predicted seconds per record of a month"""
+        return self.runtimes.get(month_key(year, month), self.mean_rate)
+
+    def order(self, jobs: list) -> tuple:
+        """Sort a batch of jobs longest predicted first and record its predicted makespan
+
+        Returns:
+            tuple: The ordered jobs, and the predicted makespan of the batch in seconds
+        """
+        durations = [(job['count'] or 0) * self.seconds_per_record(job['year'], job['month']) for job in jobs]
+        ordered = sorted(zip(jobs, durations), key=lambda item: item[1], reverse=True)
+        makespan = lpt_makespan([duration for _, duration in ordered], self.worker_count)
+        with self.lock:
+            if self.started is None:
+                self.started = time.perf_counter()
+            self.batches.append(makespan)
+        return [job for job, _ in ordered], makespan
+
+    def job_done(self, result: dict) -> None:
+        """Record the runtime of a job from its final result"""
+        if result.get('elapsed') is None:
+            return
+        with self.lock:
+            self.finished = time.perf_counter()
+            key = month_key(result['year'], result['month'])
+            seconds, records = self.measured.get(key, (0.0, 0))
+            self.measured[key] = (seconds + result['elapsed'], records + result['count'])
+
+    def predicted_makespan(self) -> float:
+        """Return the predicted makespan of every batch queued so far, in seconds"""
+        with self.lock:
+            return sum(self.batches)
+
+    def actual_makespan(self) -> float:
+        """Return the seconds from the first job being queued to the last one finishing"""
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def updated_runtimes(self) -> dict:
+        """Return the seconds per record of each month, with the months measured in this run replaced"""
+        runtimes = dict(self.runtimes)
+        for key, (seconds, records) in self.measured.items():
+            if records:
+                runtimes[key] = seconds / records
+        return runtimes
@@ -1,35 +1,141 @@
+import io
+from csv import writer
+from operator import itemgetter
+from typing import Iterable, Union
 from humps import camelize
 from opensearch_dsl.response.hit import Hit
+from ujson import dumps
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def csv_serialize(record: Hit) -> dict:
+from .config import JSON_BACKEND
+from .opensearch import CSV_FIELDS
+
+# Columns of the CSV file, filled from the `_source` fields in CSV_FIELDS in the same order
+CSV_FIELDNAMES = ["doi", "state", "client_id", "updated"]
+csv_row = itemgetter(*CSV_FIELDS)
+
+JSON_BACKENDS = ["ujson", "orjson"]
+
+# orjson writes the same numbers as ujson only for floats in this range of magnitudes, besides zero. Above it,
+# orjson writes `1e20` where ujson writes `1e+20`, and below it `0.00001` where ujson writes `1e-5`
+_ORJSON_FLOAT_RANGE = (1e-4, 1e16)
+# orjson rejects integers beyond 64 bits, signed or unsigned
+_ORJSON_INT_RANGE = (-2 ** 63, 2 ** 64)
+
+
+def check_json_backend(backend: str = JSON_BACKEND) -> str:
+    """Return the JSON backend if it can be used, by default the one set in the configuration
+
+    Raises:
+        ValueError: The backend is unknown, or is orjson and the `orjson` package is not installed.
+    """
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f"Unknown JSON backend: {backend}, expected one of {', '.join(JSON_BACKENDS)}")
+    if backend == "orjson" and orjson is None:
+        raise ValueError("The orjson JSON backend needs the orjson package, install it with `poetry install --extras orjson`")
+    return backend
+
+
+def csv_serialize_page(records: Iterable[Union[Hit, dict]]) -> bytes:
+    """Serialize a page of OpenSearch records to the rows of the CSV file in one go
+
+    Each row is taken straight from the record as a tuple, giving the same output as `csv_serialize()` and a
+    `DictWriter` without building a dict per record.
+
+    Args:
+        records (Iterable): OpenSearch records, either `Hit`s or raw `_source` dictionaries
+
+    Returns:
+        bytes: UTF-8 encoded CSV rows, one per record, without a header
+    """
+    csv_buffer = io.StringIO()
+    writer(csv_buffer).writerows(map(csv_row, records))
+    return csv_buffer.getvalue().encode()
+
+
+def json_serialize_page(records: Iterable[Union[Hit, dict]], backend: str = JSON_BACKEND) -> bytes:
+    """Serialize a page of OpenSearch records to the lines of a JSONL part in one go
+
+    Records are modified in place by `json_serialize()`, so serialize them to the CSV first.
+
+    Args:
+        records (Iterable): OpenSearch records, either `Hit`s or raw `_source` dictionaries
+        backend (str): `ujson`, or `orjson` which produces the UTF-8 bytes directly
+
+    Returns:
+        bytes: UTF-8 encoded JSON lines, one per record
+    """
+    if backend == "orjson":
+        return orjson_serialize_page([json_serialize(record) for record in records])
+    return "".join([f"{dumps(json_serialize(record), escape_forward_slashes=False, ensure_ascii=False)}\n"
+                    for record in records]).encode()
+
+
+def orjson_serialize_page(serialized_records: list) -> bytes:
+    """Encode serialized records to JSON lines with orjson, byte for byte as ujson would
+
+    The two differ on floats that either of them writes in exponent notation, and on integers that orjson rejects.
+    Records holding any such value are encoded with ujson instead.
+    """
+    lines = [dumps(record, escape_forward_slashes=False, ensure_ascii=False).encode() if _needs_ujson(record)
+             else orjson.dumps(record) for record in serialized_records]
+    return b"\n".join(lines) + b"\n" if lines else b""
+
+
+def _needs_ujson(record: dict) -> bool:
+    """Return whether a serialized record holds a number that orjson writes differently from ujson, or rejects"""
+    float_min, float_max = _ORJSON_FLOAT_RANGE
+    int_min, int_max = _ORJSON_INT_RANGE
+    values = [record]
+    while values:
+        value = values.pop()
+        value_type = type(value)
+        if value_type is dict:
+            values.extend(value.values())
+        elif value_type is list:
+            values.extend(value)
+        elif value_type is float:
+            # NaN fails the comparison as well
+            if value and not float_min <= abs(value) < float_max:
+                return True
+        elif value_type is int and not int_min <= value < int_max:
+            return True
+    return False
+
+
+def csv_serialize(record: Union[Hit, dict]) -> dict:
     """Serialize the DOI, state, client_id, and updated date from an OpenSearch record to a dictionary for the CSV file
 
     Args:
-        record (dict): OpenSearch record
+        record (dict): OpenSearch record, either a `Hit` or the raw `_source` dictionary
 
     Returns:
         dict: Serialized record
     """
     return {
-        "doi": record.uid,
-        "state": record.aasm_state,
-        "client_id": record.client_id,
-        "updated": record.updated
+        "doi": record["uid"],
+        "state": record["aasm_state"],
+        "client_id": record["client_id"],
+        "updated": record["updated"]
     }
 
 
-def json_serialize(record: Hit) -> dict:
+def json_serialize(record: Union[Hit, dict]) -> dict:
     """Apply normalizations to an OpenSearch record to match the REST API output
 
     Args:
-        record (dict): OpenSearch record
+        record (dict): OpenSearch record, either a `Hit` or the raw `_source` dictionary, which is modified in place
 
     Returns:
         dict: Serialized record
     """
     # Convert record to dictionary
-    record = record.to_dict()
+    if isinstance(record, Hit):
+        record = record.to_dict()
 
     # Extract keys that live outside `attributes`
     client_id = record.pop("client_id")
@@ -1,28 +1,51 @@
-import calendar
-from glob import iglob
+from datetime import date, timedelta
+from glob import iglob, glob
 from multiprocessing import Queue
 import os
-from .config import OUTPUT_PATH
-from .opensearch import OpenSearchClient
+import shutil
+from opensearch_dsl import Q
+from .compression import Codec, get_codec
+from .config import OUTPUT_PATH, MAX_JOB_SIZE
+from .incremental import month_key
+from .opensearch import OpenSearchClient, month_range
+from .parts import part_counts_path, load_part_counts, save_part_counts
 
 
-def generate_manifest_file() -> None:
-    """Generate a listing of the files within the datafile and save as MANIFEST."""
+def generate_manifest_file(codec: Codec = None) -> None:
+    """Generate a listing of the files within the datafile and save as MANIFEST.
+
+    Each line holds the path and size of a file, followed by its record count when the month recorded one.
+    """
+    extension = (codec or get_codec()).extension
+    part_counts = {}
+    with open(f'{OUTPUT_PATH}/MANIFEST', 'w') as manifest_file:
+        for file in iglob(f'dois/*/*{extension}', root_dir=OUTPUT_PATH):
+            month_dir, name = os.path.split(file)
+            if month_dir not in part_counts:
+                part_counts[month_dir] = load_part_counts(part_counts_path(os.path.join(OUTPUT_PATH, month_dir)))
+            count = part_counts[month_dir].get(name)
+            manifest_file.write(f'{file} {os.path.getsize(os.path.join(OUTPUT_PATH, file))}'
+                                f'{f" {count}" if count is not None else ""}\n')
+
+
+def generate_manifest_from_objects(objects: dict) -> None:
+    """Generate the MANIFEST from the objects uploaded by the s3 output backend, in the same format as
+    `generate_manifest_file()`
+
+    Args:
+        objects (dict): Lists of the objects of each month, as dicts of `key`, `size` and `count`.
+    """
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
     with open(f'{OUTPUT_PATH}/MANIFEST', 'w') as manifest_file:
-        for file in iglob(f'dois/*/*.gz', root_dir=OUTPUT_PATH):
-            manifest_file.write(f'{file} {os.path.getsize(os.path.join(OUTPUT_PATH, file))}\n')
+        for obj in sorted((obj for month_objects in objects.values() for obj in month_objects), key=lambda obj: obj['key']):
+            manifest_file.write(f"{obj['key']} {obj['size']} {obj['count']}\n")
 
 
-def get_month_count(year: int, month: int, logger=None) -> int:
+def get_month_count(year: int, month: int, logger=None, pit_id: str = None) -> int:
     """Get the record count for single month"""
     # Prepare the client for retrieving expected counts
-    agg_client = OpenSearchClient(logger=logger)
-    agg_client.build_query()
-    from_date = f"{year}-{month:02d}-01"
-    until_date = f"{year}-{month:02d}-{calendar.monthrange(year, month)[1]}"
-
-    agg_client.query = agg_client.query.filter("range", updated={"gte": f"{from_date}T00:00:00Z",
-                                                                 "lte": f"{until_date}T23:59:59Z"})
+    agg_client = OpenSearchClient(logger=logger, pit_id=pit_id)
+    agg_client.add_month_filter(year, month)
     agg_client.query = agg_client.query.extra(track_total_hits=True, size=0)
     try:
         agg_results = agg_client.query.execute()
@@ -31,23 +54,179 @@ def get_month_count(year: int, month: int, logger=None) -> int:
         logger.error(e)
 
 
-def queue_month(year: int, month: int, work_queue: Queue, results_queue: Queue, count: int = None, logger=None) -> None:
-    """Queue a month to be processed, retrieving the expected count of records if it is not provided"""
-    logger.info(f"Queueing job for {year}-{month} with expected count: {count}")
-    if count:
-        count = int(count)
-    else:
-        logger.info(f"No count for {year}-{month} provided, querying OpenSearch")
-        count = get_month_count(year, month, logger)
-
-    work_queue.put({
-        'year': int(year),
-        'month': int(month),
-        'count': count
-    })
-    results_queue.put({
-        'year': int(year),
-        'month': int(month),
-        'count': count,
-        'status': 'expected'
-    })
+def get_month_counts(months: list, logger=None, pit_id: str = None) -> dict:
+    """Get the record counts for several months with a single `filters` aggregation
+
+    Args:
+        months (list): (year, month) tuples to count.
+
+    Returns:
+        dict: Record counts keyed by (year, month). Empty if the query failed.
+    """
+    if not months:
+        return {}
+    agg_client = OpenSearchClient(logger=logger, pit_id=pit_id)
+    agg_client.build_query()
+    agg_client.query = agg_client.query.extra(size=0)
+    agg_client.query.aggs.bucket('months', 'filters',
+                                 filters={month_key(year, month): Q('range', updated=month_range(year, month))
+                                          for year, month in months})
+    try:
+        buckets = agg_client.query.execute().aggregations.months.buckets
+        return {(year, month): buckets[month_key(year, month)].doc_count for year, month in months}
+    except Exception as e:
+        logger.error(f"Failed to count {len(months)} months: {e}")
+        return {}
+
+
+def plan_month_jobs(year: int, month: int, count: int, budget: int = MAX_JOB_SIZE, logger=None, pit_id: str = None) -> list:
+    """Split a month into contiguous `updated` ranges of at most `budget` records each
+
+    A daily `date_histogram` places the boundaries, falling back to hourly buckets for any day that is itself
+    above the budget. A single hour above the budget becomes a job of its own. The first and last ranges are
+    left open so that, together with the month filter applied by the worker, they always cover the whole month.
+
+    Returns:
+        list: List of (gte, lt, count) tuples, with None for an open end. A month within the budget is one open range.
+    """
+    if not budget or count <= budget:
+        return [(None, None, count)]
+
+    client = OpenSearchClient(logger=logger, pit_id=pit_id)
+    client.build_query()
+    client.add_month_filter(year, month)
+    buckets = []
+    for day, day_count in client.get_histogram('1d'):
+        if day_count > budget:
+            day_client = OpenSearchClient(logger=logger, pit_id=pit_id)
+            day_client.query = client.query
+            next_day = date.fromisoformat(day[:10]) + timedelta(days=1)
+            day_client.add_range_filter(gte=day, lt=f"{next_day.isoformat()}T00:00:00Z")
+            buckets.extend(day_client.get_histogram('1h'))
+        else:
+            buckets.append((day, day_count))
+
+    # Group consecutive buckets greedily until adding the next one would exceed the budget
+    groups = []
+    for key, bucket_count in buckets:
+        if groups and groups[-1][1] + bucket_count <= budget:
+            groups[-1][1] += bucket_count
+        else:
+            groups.append([key, bucket_count])
+    if not groups:
+        return [(None, None, count)]
+
+    edges = [None] + [key for key, _ in groups[1:]] + [None]
+    return [(gte, lt, group_count) for gte, lt, (_, group_count) in zip(edges[:-1], edges[1:], groups)]
+
+
+def finalize_month(year: int, month: int, codec: Codec = None) -> None:
+    """Merge the output of a month that was split into several jobs
+
+    Each job of a split month writes `subXXX_part_YYYY.jsonl.gz` and `subXXX_YYYY-MM.csv.gz` files, or `.zst` for
+    zstd. The parts are renamed into one contiguous `part_XXXX.jsonl.gz` sequence and the CSV pieces, which are
+    complete compressed members with a header only in the first, are concatenated into the month CSV.
+    """
+    output_dir = f"{OUTPUT_PATH}/dois/updated_{year}-{month:02d}"
+    extension = (codec or get_codec()).extension
+
+    # Remove parts left over from an earlier generation of this month
+    for stale in glob(f"{output_dir}/part_*.jsonl{extension}"):
+        os.remove(stale)
+
+    # Record counts of the job files, under the names they are merged into
+    job_counts = {}
+    for path in glob(part_counts_path(output_dir, "sub*_")):
+        job_counts.update(load_part_counts(path))
+        os.remove(path)
+    part_counts = {}
+
+    for index, part in enumerate(sorted(glob(f"{output_dir}/sub*_part_*.jsonl{extension}"))):
+        name = f"part_{index:04d}.jsonl{extension}"
+        os.rename(part, f"{output_dir}/{name}")
+        if os.path.basename(part) in job_counts:
+            part_counts[name] = job_counts[os.path.basename(part)]
+
+    pieces = sorted(glob(f"{output_dir}/sub*_{year}-{month:02d}.csv{extension}"))
+    with open(f"{output_dir}/{year}-{month:02d}.csv{extension}", "wb") as csv_file:
+        for piece in pieces:
+            with open(piece, "rb") as piece_file:
+                shutil.copyfileobj(piece_file, csv_file)
+    for piece in pieces:
+        os.remove(piece)
+    if all(os.path.basename(piece) in job_counts for piece in pieces):
+        part_counts[f"{year}-{month:02d}.csv{extension}"] = sum(job_counts[os.path.basename(piece)] for piece in pieces)
+    save_part_counts(part_counts_path(output_dir), part_counts)
+
+
+def queue_months(months: list, work_queue: Queue, results_queue: Queue, logger=None, pit_id: str = None,
+                 scheduler=None) -> None:
+    """Queue several months to be processed, retrieving the expected count of any month that has none
+
+    The expected results of every month are reported before any job is queued, and the jobs are queued in the
+    order given by `scheduler`, longest first, or month by month without one.
+
+    Args:
+        months (list): (year, month, count) tuples, with None for a count to retrieve.
+        work_queue (Queue): Queue for the jobs.
+        results_queue (Queue): Queue for the expected results.
+        logger: Logger to use.
+        pit_id (str): Point-in-time ID for the jobs.
+        scheduler (JobScheduler): Scheduler that orders the jobs.
+    """
+    jobs = []
+    for year, month, count in months:
+        logger.info(f"Queueing job for {year}-{month} with expected count: {count}")
+        if count is not None:
+            count = int(count)
+        else:
+            logger.info(f"No count for {year}-{month} provided, querying OpenSearch")
+            count = get_month_count(year, month, logger, pit_id=pit_id)
+
+        # Split months above the record budget into several jobs
+        ranges = [(None, None, count)]
+        if count and MAX_JOB_SIZE and count > MAX_JOB_SIZE:
+            try:
+                ranges = plan_month_jobs(int(year), int(month), count, logger=logger, pit_id=pit_id)
+                logger.info(f"Split {year}-{month} into {len(ranges)} jobs: {[c for _, _, c in ranges]}")
+            except Exception as e:
+                logger.error(f"Failed to split {year}-{month}, queueing as a single job: {e}")
+
+        results_queue.put({
+            'year': int(year),
+            'month': int(month),
+            'count': count,
+            'parts': len(ranges),
+            'status': 'expected'
+        })
+        for part, (gte, lt, part_count) in enumerate(ranges):
+            jobs.append({
+                'year': int(year),
+                'month': int(month),
+                'count': part_count,
+                'pit_id': pit_id,
+                'part': part,
+                'parts': len(ranges),
+                'from': gte,
+                'until': lt
+            })
+
+    if scheduler and jobs:
+        jobs, makespan = scheduler.order(jobs)
+        first = ", ".join(f"{job['year']}-{job['month']} ({job['count']})" for job in jobs[:5])
+        logger.info(f"Scheduled {len(jobs)} jobs longest first with a predicted makespan of {makespan:.1f}s, "
+                    f"starting with {first}")
+    for job in jobs:
+        work_queue.put(job)
+
+
+def carry_month(year: int, month: int, results_queue: Queue, count: int, logger=None) -> None:
+    """Keep the output of an unchanged month from the previous run, reporting it as already final"""
+    logger.info(f"Carrying over {year}-{month} from the previous run with count: {count}")
+    for status in ('expected', 'final'):
+        results_queue.put({
+            'year': int(year),
+            'month': int(month),
+            'count': count,
+            'status': status
+        })
@@ -1,19 +1,40 @@
-import gzip
+import io
 import logging
 import os
+import threading
+import time
 from logging.handlers import QueueHandler
 from queue import Queue
-from csv import DictWriter
+from csv import writer
+from glob import glob
+from typing import NamedTuple
 
-from ujson import dumps
+from .checkpoint import checkpoint_path, load_checkpoint, save_checkpoint, remove_checkpoint
+from .config import OUTPUT_PATH, SLICES, SLICE_MIN_COUNT, JOB_RETRIES, PIPELINE_BATCH_SIZE, PART_MAX_RECORDS, \
+    PART_MAX_BYTES, OUTPUT_BACKEND, DATAFILE_BUCKET, S3_STAGING_PREFIX, HEARTBEAT_INTERVAL
+from .opensearch import OpenSearchClient, CSV_FIELDS, merge_slices
+from .parts import part_counts_path, load_part_counts, save_part_counts
+from .pipeline import PipelineStage
+from .s3 import S3MultipartFile
+from .compression import Codec, get_codec
+from .writer import BufferedCompressedWriter
+from .serializer import CSV_FIELDNAMES, csv_serialize_page, json_serialize_page
+from .exceptions import FatalWorkerError, JobCancelled, TooManyFailures, TooManyTimeouts
 
-from .config import OUTPUT_PATH
-from .opensearch import OpenSearchClient
-from .serializer import json_serialize, csv_serialize
-from .exceptions import FatalWorkerError
+class SerializedBatch(NamedTuple):
+    """Serialized records handed from the serialize stage to the write stage
+
+    `positions` is only set on a batch that ends a part, and is the checkpoint to record once it is written.
+    """
+    csv: bytes
+    jsonl: bytes
+    count: int
+    findable: int
+    positions: dict
 
 
-def month_worker(worker_id: int, work_queue: Queue, results_queue: Queue, log_queue: Queue) -> None:
+def month_worker(worker_id: int, work_queue: Queue, results_queue: Queue, log_queue: Queue, retry_budget=None,
+                 codec: Codec = None, backend: str = None, current_jobs=None, cancelled_jobs=None) -> None:
     """Retrieve job from the queue and process it
 
     Args:
@@ -21,100 +42,408 @@ def month_worker(worker_id: int, work_queue: Queue, results_queue: Queue, log_qu
         work_queue (Queue): Queue containing jobs.
         results_queue (Queue): Queue to use for reporting results.
         log_queue (Queue): Queue to use for logging.
+        retry_budget (multiprocessing.Value): Retries of failed searches left for the whole run.
+        codec (Codec): Compression codec and level of the output files, by default the one set in the configuration.
+        backend (str): `local` to write output files under OUTPUT_PATH or `s3` to upload them straight to
+            DATAFILE_BUCKET, by default the one set in the configuration. Jobs written to S3 can't be truncated back
+            to a checkpoint, so they start over when retried, and report the objects they completed instead.
+        current_jobs (dict): Shared dict in which the worker keeps the job it is processing under its ID, so that the
+            supervisor can requeue the job if the worker dies.
+        cancelled_jobs (dict): Shared dict in which the results thread marks the job of a worker as cancelled, under
+            the worker ID. The worker then gives the job back to the queue.
+
+    While a job is processed, a heartbeat with its progress is put on `results_queue` every HEARTBEAT_INTERVAL
+    seconds, for the results thread to follow its throughput and spot it stalling. Cancellation is checked after
+    every heartbeat.
     """
     queue_handler = QueueHandler(log_queue)
     logger = logging.getLogger(f"worker-{worker_id}")
     # logger.propagate = False
     logger.addHandler(queue_handler)
     logger.debug(f"Worker {worker_id} started")
+    codec = codec or get_codec()
+    backend = backend or OUTPUT_BACKEND
+    local = backend == "local"
 
     while True:
         job = work_queue.get()
         if job is None:
             logger.info(f"Worker {worker_id} received None, stopping...")
             break
+        if current_jobs is not None:
+            # Record when the job started, so that the supervisor can count this attempt if the worker dies
+            current_jobs[worker_id] = {**job, 'started': time.time()}
 
         # Parse the job information
         year = job['year']
         month = job['month']
         expected_count = job['count']
-        logger.info(f"Worker {worker_id} started processing job for {year}-{month} with expected count {expected_count}")
+        part = job.get('part', 0)
+        parts = job.get('parts', 1)
+        job_start = time.perf_counter()
+        logger.info(f"Worker {worker_id} started processing job for {year}-{month}"
+                    f"{f' (part {part + 1}/{parts})' if parts > 1 else ''} with expected count {expected_count}")
 
         # Process the job
 
         # Make sure output directory exists
         output_dir = f"{OUTPUT_PATH}/dois/updated_{year}-{month:02d}"
         try:
-              if not os.path.exists(output_dir):
+              if local and not os.path.exists(output_dir):
                 os.makedirs(output_dir)
         except Exception as e:
             logger.error(f"Worker {worker_id} failed to create output directory {output_dir}: {e}")
             raise FatalWorkerError
 
-        client = OpenSearchClient(logger=logger)
-        client.build_query()
-        client.filter_fields()
-        client.add_month_filter(year, month)
+        # Findable records are fetched in full for the JSONL, registered records only with the fields for the CSV
+        clients = {}
+        for state, field_list in (("findable", None), ("registered", CSV_FIELDS)):
+            client = OpenSearchClient(logger=logger, pit_id=job.get('pit_id'), retry_budget=retry_budget)
+            client.build_query(states=[state])
+            client.filter_fields(field_list)
+            client.add_month_filter(year, month)
+            client.add_range_filter(job.get('from'), job.get('until'))
+            clients[state] = client
 
         results_count = 0
         current_file_index = 0
+        positions = {state: {} for state in clients}
+        ranges = {}
+
+        # Jobs for a split month write prefixed files, which are merged once every job for the month is done
+        file_prefix = f"sub{part:03d}_" if parts > 1 else ""
+        json_file_path = f"{output_dir}/{file_prefix}part_{current_file_index:04d}.jsonl{codec.extension}"
+        csv_file_path = f"{output_dir}/{file_prefix}{year}-{month:02d}.csv{codec.extension}"
+
+        # Record counts of the files written by the job, for the manifest
+        job_part_counts_path = part_counts_path(output_dir, file_prefix)
+        part_counts = {}
+        part_records = 0
+        # Sizes of the objects completed by the job, for the s3 backend
+        object_sizes = {}
+
+        # Resume from the last part rotation if an earlier attempt at this job failed
+        job_checkpoint_path = checkpoint_path(output_dir, file_prefix)
+        checkpoint = load_checkpoint(job_checkpoint_path, job) if local else None
+        if checkpoint:
+            results_count = checkpoint['count']
+            current_file_index = checkpoint['part_index']
+            positions = checkpoint['positions']
+            ranges = checkpoint['ranges']
+            json_file_path = f"{output_dir}/{file_prefix}part_{current_file_index:04d}.jsonl{codec.extension}"
+            part_counts = {name: count for name, count in load_part_counts(job_part_counts_path).items()
+                           if name < os.path.basename(json_file_path)}
+            logger.info(f"Worker {worker_id} resuming job for {year}-{month} from part {current_file_index} "
+                        f"with {results_count} records already written")
+        elif local:
+            # Remove the output of an earlier generation of the job, which may have had more parts than this one
+            for stale in glob(f"{output_dir}/{file_prefix}part_*.jsonl{codec.extension}"):
+                os.remove(stale)
+            for stale in (csv_file_path, job_part_counts_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
 
         # Open the output files
-        json_file_path = f"{OUTPUT_PATH}/dois/updated_{year}-{month:02d}/part_{current_file_index:04d}.jsonl.gz"
-        csv_file_path = f"{OUTPUT_PATH}/dois/updated_{year}-{month:02d}/{year}-{month:02d}.csv.gz"
         try:
-            # Write direct to gzip
-            json_output_file = gzip.open(json_file_path, "wt")
+            # Write direct to the compressed file
+            json_output_file = BufferedCompressedWriter(open_output_file(json_file_path, backend, codec), codec)
         except Exception as e:
             logger.error(f"Worker {worker_id} failed to open file {json_file_path} for writing: {e}")
             raise FatalWorkerError
 
         try:
-            csv_output_file = gzip.open(csv_file_path, "wt")
-            csv_writer = DictWriter(csv_output_file, fieldnames=["doi", "state", "client_id", "updated"])
-            csv_writer.writeheader()
+            # The CSV is written as one compressed member per part, so that it can be cut back to the last checkpoint
+            if checkpoint:
+                csv_raw_file = open(csv_file_path, "r+b")
+                csv_raw_file.truncate(checkpoint['csv_offset'])
+                csv_raw_file.seek(0, os.SEEK_END)
+            else:
+                csv_raw_file = open_output_file(csv_file_path, backend, codec)
+            csv_output_file = BufferedCompressedWriter(csv_raw_file, codec)
+            if part == 0 and not checkpoint:
+                csv_header = io.StringIO()
+                writer(csv_header).writerow(CSV_FIELDNAMES)
+                csv_output_file.write(csv_header.getvalue().encode())
         except Exception as e:
             logger.error(f"Worker {worker_id} failed to open file {csv_file_path} for writing: {e}")
             raise FatalWorkerError
 
+        # Split the largest months across several concurrent cursors
+        slices = SLICES if expected_count and expected_count >= SLICE_MIN_COUNT else 1
+
+        # Uncompressed bytes written by this attempt at the job, for heartbeats
+        bytes_written = 0
+
+        def job_progress() -> dict:
+            return {"count": results_count, "bytes": bytes_written,
+                    "pages": sum(client.stats["pages"] for client in clients.values()),
+                    "search_after": {name: dict(cursors) for name, cursors in positions.items()}}
+
+        # Identifies this attempt at the job, so that a cancellation meant for an earlier job is ignored
+        job_key = (year, month, part, job.get('attempt', 0))
+
+        def check_cancelled() -> bool:
+            if cancelled_jobs is None or cancelled_jobs.get(worker_id) != job_key:
+                return False
+            # Fail the write loop even if the fetch stage is stuck waiting for OpenSearch
+            serialize_stage.cancel(JobCancelled(f"no progress after {results_count} records"))
+            return True
+
+        stages = []
+        heartbeat_stop = threading.Event()
+        heartbeat = None
         try:
-            results = client.return_all_results()
+            # Both streams are split into the same ranges, placed by the findable records that make up most of a month
+            if slices > 1 and not ranges:
+                slice_ranges = clients["findable"].get_slice_ranges(slices)
+                ranges = {state: slice_ranges for state in clients}
+                logger.info(f"Worker {worker_id} fetching {year}-{month} with {len(slice_ranges)} slices")
+
+            # Both streams are merged back into sort order, so the CSV is written as if from a single query. Slices
+            # are merged separately and fetched concurrently, so their records are interleaved
+            records = merge_slices({state: client.return_cursor_pages(ranges.get(state), raw=True,
+                                                                      positions=positions[state])
+                                    for state, client in clients.items()})
 
-            for result in results:
-                results_count += 1
+            # Fetching, serializing and compressing run concurrently, each stage handing batches to the next
+            fetch_stage = PipelineStage("fetch", fetch_batches(records)).start()
+            serialize_stage = PipelineStage("serialize", serialize_batches(fetch_stage, positions, results_count),
+                                            upstream=fetch_stage).start()
+            stages = [fetch_stage, serialize_stage]
+            write_start = time.perf_counter()
+            if HEARTBEAT_INTERVAL:
+                job_info = {"worker": worker_id, "year": year, "month": month, "part": part, "parts": parts,
+                            "attempt": job.get('attempt', 0), "expected": expected_count}
+                heartbeat = threading.Thread(target=heartbeat_thread, daemon=True,
+                                             args=(results_queue, heartbeat_stop, HEARTBEAT_INTERVAL, job_info,
+                                                   job_progress, check_cancelled))
+                heartbeat.start()
 
-                # Write everything to the CSV
-                csv_writer.writerow(csv_serialize(result))
+            # Progress is logged at info level every `progress_interval` records for long-running months
+            progress_interval = 200000 if expected_count >= 1000000 else 50000 if expected_count >= 100000 else None
+            logged_count = results_count
 
-                # Only write to JSONL if the record is findable
-                if result.aasm_state == "findable":
-                    serialized_record = json_serialize(result)
-                    json_output_file.write(f"{dumps(serialized_record, escape_forward_slashes=False, ensure_ascii=False)}\n")
-                    json_output_file.flush()
+            for batch in serialize_stage:
+                csv_output_file.write(batch.csv)
+                json_output_file.write(batch.jsonl)
+                csv_output_file.end_page()
+                json_output_file.end_page()
+                part_records += batch.findable
+                bytes_written += len(batch.csv) + len(batch.jsonl)
 
-                if results_count % 10000 == 0:
+                if batch.positions is not None:
                     # For long-running months, increase log messages for easier tracking during generation
-                    if (expected_count >= 1000000 and results_count % 200000 == 0) or (100000 <= expected_count < 1000000 and results_count % 50000 == 0):
-                        logger.info(f"Worker {worker_id} processed {results_count}/{expected_count} records for {year}-{month}")
+                    if progress_interval and batch.count // progress_interval > logged_count // progress_interval:
+                        logger.info(f"Worker {worker_id} processed {batch.count}/{expected_count} records for {year}-{month}")
                     else:
-                        logger.debug(f"Worker {worker_id} processed {results_count}/{expected_count} records for {year}-{month}")
+                        logger.debug(f"Worker {worker_id} processed {batch.count}/{expected_count} records for {year}-{month}")
+                    logged_count = batch.count
+                    part_counts[os.path.basename(json_file_path)] = part_records
+                    part_records = 0
                     current_file_index += 1
-                    json_file_path = f"{OUTPUT_PATH}/dois/updated_{year}-{month:02d}/part_{current_file_index:04d}.jsonl.gz"
+                    json_file_path = f"{output_dir}/{file_prefix}part_{current_file_index:04d}.jsonl{codec.extension}"
                     try:
-                        # Close the JSONL file and open the next file
+                        # Close the JSONL file and CSV member, record the checkpoint and open the next ones
                         json_output_file.close()
-                        json_output_file = gzip.open(json_file_path, "wt")
+                        csv_offset = csv_output_file.end_member()
+                        if local:
+                            save_part_counts(job_part_counts_path, part_counts)
+                            save_checkpoint(job_checkpoint_path, job, {name: c.ranges for name, c in clients.items()},
+                                            batch.positions, current_file_index, batch.count, csv_offset)
+                        else:
+                            object_sizes[json_output_file.raw_file.key] = json_output_file.raw_file.size
+                        json_output_file = BufferedCompressedWriter(open_output_file(json_file_path, backend, codec),
+                                                                    codec)
                     except Exception as e:
                         logger.error(f"Worker {worker_id} failed to open file {json_file_path} for writing: {e}")
                         raise FatalWorkerError
+                results_count = batch.count
 
             # Close the last files and report results
             csv_output_file.close()
             json_output_file.close()
-            results_queue.put({"year": year, "month": month, "count": results_count, "status": "final"}, block=True)
+            part_counts[os.path.basename(json_file_path)] = part_records
+            part_counts[os.path.basename(csv_file_path)] = results_count
+            write_busy = time.perf_counter() - write_start - serialize_stage.get_wait
+            result = {"year": year, "month": month, "count": results_count, "part": part, "parts": parts,
+                      "elapsed": job.get('elapsed', 0.0) + time.perf_counter() - job_start}
+            if local:
+                save_part_counts(job_part_counts_path, part_counts)
+                remove_checkpoint(job_checkpoint_path)
+            else:
+                for f in (json_output_file, csv_output_file):
+                    object_sizes[f.raw_file.key] = f.raw_file.size
+                result["objects"] = [{"key": key, "size": size, "count": part_counts[os.path.basename(key)]}
+                                     for key, size in object_sizes.items()]
+            stats = combine_stats(client.stats for client in clients.values())
+            # No heartbeat may follow the final result of the job
+            stop_heartbeat(heartbeat, heartbeat_stop)
+            results_queue.put({**result, "retries": stats["retries"], "retry_sleep": stats["retry_sleep"],
+                               "status": "final"}, block=True)
             logger.info(f"Worker {worker_id} finished processing job for {year}-{month} with final count {results_count}")
+            logger.debug(f"Worker {worker_id} waited {stats['wait_time']:.1f}s for {stats['pages']} pages from OpenSearch for {year}-{month}")
+            logger.info(f"Worker {worker_id} pipeline for {year}-{month}: "
+                        f"fetch busy {fetch_stage.busy:.1f}s, "
+                        f"serialize busy {serialize_stage.busy:.1f}s (queue depth {fetch_stage.mean_depth:.1f}), "
+                        f"write busy {write_busy:.1f}s (queue depth {serialize_stage.mean_depth:.1f})")
+            if current_jobs is not None:
+                current_jobs.pop(worker_id, None)
+            work_queue.task_done()
+
+        except (TooManyFailures, TooManyTimeouts, JobCancelled) as e:
+            # Give the job back to the queue, it will resume from its last checkpoint
+            stop_heartbeat(heartbeat, heartbeat_stop)
+            if cancelled_jobs is not None:
+                cancelled_jobs.pop(worker_id, None)
+            for f in (json_output_file, csv_output_file):
+                try:
+                    f.abort()
+                except Exception:
+                    pass
+            attempt = job.get('attempt', 0) + 1
+            if attempt > JOB_RETRIES:
+                logger.error(f"Worker {worker_id} failed to process job for {year}-{month} after {attempt} attempts: {e!r}")
+                raise FatalWorkerError
+            logger.warning(f"Worker {worker_id} failed to process job for {year}-{month} ({e!r}), "
+                           f"requeueing (attempt {attempt}/{JOB_RETRIES})")
+            # The time spent on earlier attempts counts towards the job's runtime
+            work_queue.put({**job, 'attempt': attempt, 'elapsed': job.get('elapsed', 0.0) + time.perf_counter() - job_start})
+            if current_jobs is not None:
+                current_jobs.pop(worker_id, None)
             work_queue.task_done()
 
         except Exception as e:
             logger.error(f"Worker {worker_id} failed to process job for {year}-{month}: {e}")
+            if not local:
+                # Don't leave incomplete multipart uploads behind in the bucket
+                for f in (json_output_file, csv_output_file):
+                    try:
+                        f.abort()
+                    except Exception:
+                        pass
             raise FatalWorkerError
+
+        finally:
+            stop_heartbeat(heartbeat, heartbeat_stop)
+            for stage in stages:
+                stage.close()
+
+
+def heartbeat_thread(results_queue: Queue, stop_event: threading.Event, interval: float, job_info: dict,
+                     progress, cancelled=None) -> None:
+    """Thread that reports the progress of a job on the results queue until the job ends or is cancelled
+
+    Args:
+        results_queue (Queue): Queue to put heartbeats on.
+        stop_event (threading.Event): Event set when the job ends.
+        interval (float): Seconds between heartbeats.
+        job_info (dict): Worker and job the heartbeats are for.
+        progress: Function returning the records done, pages fetched, bytes written and `search_after` of each
+            cursor so far.
+        cancelled: Function called after every heartbeat, returning True once it has cancelled the job.
+    """
+    while not stop_event.wait(interval):
+        try:
+            results_queue.put({**job_info, **progress(), "status": "heartbeat"})
+            if cancelled is not None and cancelled():
+                return
+        except Exception:
+            # A missed heartbeat only delays the monitor, it must never fail the job
+            pass
+
+
+def stop_heartbeat(heartbeat: threading.Thread, stop_event: threading.Event) -> None:
+    """Stop the heartbeat thread of a job, if it was started, and wait for its last heartbeat to be queued"""
+    stop_event.set()
+    if heartbeat is not None:
+        heartbeat.join()
+
+
+def open_output_file(path: str, backend: str, codec: Codec):
+    """Open an output file under OUTPUT_PATH for writing, or for the s3 backend an upload to the same key under
+    S3_STAGING_PREFIX in DATAFILE_BUCKET"""
+    if backend == "s3":
+        return S3MultipartFile(DATAFILE_BUCKET, S3_STAGING_PREFIX + os.path.relpath(path, OUTPUT_PATH),
+                               content_type=codec.content_type)
+    return open(path, "wb")
+
+
+def fetch_batches(records, batch_size: int = PIPELINE_BATCH_SIZE):
+    """Group merged records from `merge_slices()` into lists of up to `batch_size` for the serialize stage"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def serialize_batches(batches, positions: dict, count: int, max_records: int = PART_MAX_RECORDS,
+                      max_bytes: int = PART_MAX_BYTES):
+    """Serialize batches of records to their CSV rows and, for findable records, JSONL lines
+
+    Each batch is serialized a page at a time with `csv_serialize_page()` and `json_serialize_page()`. A batch is
+    cut short to end the current part at the findable record that brings the part to `max_records`, and a part
+    also ends after the first batch that brings it to `max_bytes` bytes of JSONL, so that parts are sized by what
+    is actually written to them.
+
+    Args:
+        batches: Iterator of lists of (stream name, cursor index, sort values, hit) tuples.
+        positions (dict): Sort values of the last record of each cursor, keyed by stream name and cursor index,
+            updated as records are serialized.
+        count (int): Number of records already written by the job.
+        max_records (int): Number of findable records in each part.
+        max_bytes (int): Number of bytes of JSONL in each part, 0 for no limit.
+
+    Yields:
+        SerializedBatch: The serialized records, with a copy of `positions` if the batch ends a part.
+    """
+    part_records = 0
+    part_bytes = 0
+    for batch in batches:
+        start = 0
+        while start < len(batch):
+            # Take records up to the end of the batch or the one that fills the current part
+            end = start
+            findable = 0
+            while end < len(batch):
+                state = batch[end][0]
+                end += 1
+                if state == "findable":
+                    findable += 1
+                    if part_records + findable >= max_records:
+                        break
+            page = batch[start:end]
+            start = end
+
+            for state, cursor, sort, _ in page:
+                positions[state][cursor] = sort
+            count += len(page)
+
+            # Write everything to the CSV, and only findable records to the JSONL
+            csv = csv_serialize_page(result for _, _, _, result in page)
+            jsonl = json_serialize_page(result for state, _, _, result in page if state == "findable")
+            part_records += findable
+            part_bytes += len(jsonl)
+
+            if part_records >= max_records or (max_bytes and part_bytes >= max_bytes):
+                yield SerializedBatch(csv, jsonl, count, findable,
+                                      {name: dict(cursors) for name, cursors in positions.items()})
+                part_records = 0
+                part_bytes = 0
+            else:
+                yield SerializedBatch(csv, jsonl, count, findable, None)
+
+
+def combine_stats(all_stats) -> dict:
+    """Add up the `stats` of several `OpenSearchClient` objects"""
+    combined = {"pages": 0, "wait_time": 0.0, "retries": {}, "retry_sleep": 0.0}
+    for stats in all_stats:
+        combined["pages"] += stats.get("pages", 0)
+        combined["wait_time"] += stats.get("wait_time", 0.0)
+        combined["retry_sleep"] += stats.get("retry_sleep", 0.0)
+        for kind, count in stats.get("retries", {}).items():
+            combined["retries"][kind] = combined["retries"].get(kind, 0) + count
+    return combined
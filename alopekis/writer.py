@@ -0,0 +1,101 @@
+import io
+import os
+
+from .compression import Codec, get_codec
+from .config import WRITE_BUFFER_BYTES, DURABILITY
+
+
+class BufferedCompressedWriter:
+    def __init__(self, raw_file, codec: Codec = None, buffer_size=WRITE_BUFFER_BYTES, durability=DURABILITY):
+        """
+        Initialize a BufferedCompressedWriter object.
+
+        Serialized bytes are collected in memory and compressed in a single write once `buffer_size` bytes
+        are waiting, rather than line by line. The file is written as a sequence of compressed members, see
+        `end_member()`, each of which decompresses as part of the same stream.
+
+        Args:
+            raw_file: Binary file opened for writing, positioned where the first member should start, or an
+                `S3MultipartFile`.
+            codec (Codec): Compression codec and level, by default the one set in the configuration.
+            buffer_size (int): Number of bytes to collect before writing them.
+            durability (str): When written data is pushed to disk. `page` flushes the compressor after every
+                page, `part` syncs the file at the end of every member, and `never` leaves it to the OS until
+                the file is closed.
+        """
+        self.raw_file = raw_file
+        self.codec = codec or get_codec()
+        self.buffer_size = buffer_size
+        self.durability = durability
+        self.buffer = []
+        self.buffered = 0
+        self.stream = self.codec.open_member(raw_file)
+
+    def write(self, data: bytes) -> None:
+        """Add serialized bytes to the buffer, writing the buffer out once it is full"""
+        if not data:
+            return
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self._drain()
+
+    def _drain(self):
+        if self.buffer:
+            self.stream.write(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def end_page(self) -> None:
+        """Mark the end of a page of records, flushing it through the compressor for `page` durability"""
+        if self.durability == "page":
+            self._drain()
+            self.stream.flush()
+
+    def end_member(self) -> int:
+        """Finish the current compressed member and start the next one
+
+        Returns:
+            int: Length of the file up to the end of the finished member, which it can later be truncated to.
+        """
+        self._finish_member()
+        offset = self.raw_file.tell()
+        self.stream = self.codec.open_member(self.raw_file)
+        return offset
+
+    def _finish_member(self):
+        self._drain()
+        self.stream.close()
+        self.raw_file.flush()
+        if self.durability in ("page", "part"):
+            try:
+                fileno = self.raw_file.fileno()
+            except io.UnsupportedOperation:
+                # Not a local file, e.g. an S3 upload, so there is nothing to sync
+                return
+            os.fsync(fileno)
+
+    def close(self) -> None:
+        """Write out anything still buffered and close the file"""
+        if self.raw_file.closed:
+            return
+        try:
+            self._finish_member()
+        finally:
+            self.raw_file.close()
+
+    def abort(self) -> None:
+        """Give up on the file after a failure
+
+        An S3 upload is discarded rather than completed with partial data. A local file is closed as it is,
+        since a resumed job truncates it back to its last checkpoint anyway.
+        """
+        if not hasattr(self.raw_file, "abort"):
+            self.close()
+            return
+        self.raw_file.abort()
+        try:
+            self.stream.close()
+        except ValueError:
+            # The compressor can't write its trailer to the aborted upload
+            pass
@@ -0,0 +1,67 @@
+"""Compare output codecs and compression levels on a sample month.
+
+A month of sample records is serialized to the bytes of its JSONL parts and CSV, and compressed with each codec
+and level through `Codec.open_member()`, as `month_worker` does. Throughput is uncompressed MB per second of
+wall time, and the ratio is uncompressed over compressed size. zstd is skipped if `zstandard` is not installed.
+
+Usage:
+    python -m benchmarks.codecs [--records 20000] [--gzip-levels 1 4 6 9] [--zstd-levels 1 3 6 9 12]
+                                [--threads 0] [--repeat 3] [--fixture month.jsonl]
+"""
+import argparse
+import io
+import time
+
+from alopekis.compression import Codec, zstandard
+from alopekis.serializer import csv_serialize_page, json_serialize_page
+from benchmarks.sample import sample_sources
+
+
+def sample_month(records: int, fixture: str = None) -> tuple:
+    """Serialize sample records to the bytes of a month's JSONL parts and CSV"""
+    sources = list(sample_sources(records, fixture))
+    csv = csv_serialize_page(sources)
+    return json_serialize_page(sources), csv
+
+
+def measure(codec: Codec, data: bytes, threads: int, repeat: int) -> tuple:
+    """Return the lowest wall seconds over `repeat` runs and the compressed size"""
+    best = None
+    for _ in range(repeat):
+        raw_file = io.BytesIO()
+        start = time.perf_counter()
+        stream = codec.open_member(raw_file, threads=threads)
+        for i in range(0, len(data), 1024 * 1024):
+            stream.write(data[i:i + 1024 * 1024])
+        stream.close()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(raw_file.getvalue())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000, help="Number of records in the sample month")
+    parser.add_argument("--gzip-levels", type=int, nargs="*", default=[1, 4, 6, 9], help="gzip levels to try")
+    parser.add_argument("--zstd-levels", type=int, nargs="*", default=[1, 3, 6, 9, 12], help="zstd levels to try")
+    parser.add_argument("--threads", type=int, default=0, help="Compression threads, see COMPRESSION_THREADS")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest is reported")
+    parser.add_argument("--fixture", type=str, default=None, help="JSONL file of raw `_source` documents")
+    args = parser.parse_args()
+
+    files = dict(zip(("JSONL", "CSV"), sample_month(args.records, args.fixture)))
+    settings = [Codec("gzip", level) for level in args.gzip_levels]
+    if zstandard is not None:
+        settings += [Codec("zstd", level) for level in args.zstd_levels]
+    else:
+        print("zstandard is not installed, skipping zstd")
+
+    print(f"Records: {args.records}, threads: {args.threads}, runs: {args.repeat}")
+    for name, data in files.items():
+        size = len(data)
+        print(f"\n{name}: {size / 1024 / 1024:.1f} MB uncompressed")
+        print(f"{'codec':<6} {'level':>5} {'MB/s':>8} {'ratio':>7} {'bytes':>10}")
+        for codec in settings:
+            elapsed, compressed = measure(codec, data, args.threads, args.repeat)
+            print(f"{codec.name:<6} {codec.level:>5} {size / 1024 / 1024 / elapsed:>8.1f} {size / compressed:>7.2f} "
+                  f"{compressed:>10}")
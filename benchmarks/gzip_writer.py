@@ -0,0 +1,65 @@
+"""Compare the single-stream `gzip.GzipFile` writer against the block-parallel `ParallelGzipFile` writer.
+
+Both writers compress the same JSONL text, serialized from sample records the way the JSONL part files are, and
+the output of each is checked to decompress back to the input. Wall time is reported, since the point of the
+parallel writer is to spread compression over several cores.
+
+Usage:
+    python -m benchmarks.gzip_writer [--records 20000] [--threads 1 2 4] [--repeat 3] [--fixture month.jsonl]
+"""
+import argparse
+import gzip
+import io
+import time
+
+from alopekis.compression import ParallelGzipFile
+from alopekis.serializer import json_serialize_page
+from benchmarks.sample import sample_sources
+
+
+def sample_jsonl(records: int, fixture: str = None) -> bytes:
+    """Serialize sample records to the text of a JSONL part file"""
+    return json_serialize_page(sample_sources(records, fixture))
+
+
+def gzip_writer(raw_file, threads):
+    return gzip.GzipFile(fileobj=raw_file, mode="wb")
+
+
+def parallel_writer(raw_file, threads):
+    return ParallelGzipFile(raw_file, threads=threads)
+
+
+def measure(open_writer, data: bytes, threads: int, repeat: int) -> tuple:
+    """Return the lowest wall seconds over `repeat` runs and the compressed size"""
+    best = None
+    for _ in range(repeat):
+        raw_file = io.BytesIO()
+        start = time.perf_counter()
+        with open_writer(raw_file, threads) as f:
+            for i in range(0, len(data), 64 * 1024):
+                f.write(data[i:i + 64 * 1024])
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert gzip.decompress(raw_file.getvalue()) == data
+    return best, len(raw_file.getvalue())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000, help="Number of records to compress")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4], help="Thread counts to try")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest is reported")
+    parser.add_argument("--fixture", type=str, default=None, help="JSONL file of raw `_source` documents")
+    args = parser.parse_args()
+
+    data = sample_jsonl(args.records, args.fixture)
+    mb = len(data) / 1024 / 1024
+    print(f"Records: {args.records}, {mb:.1f} MB uncompressed, runs: {args.repeat}")
+
+    base_time, base_size = measure(gzip_writer, data, 0, args.repeat)
+    print(f"gzip.GzipFile:          {base_time:.2f} s, {mb / base_time:.1f} MB/s, {base_size} bytes")
+    for threads in args.threads:
+        elapsed, size = measure(parallel_writer, data, threads, args.repeat)
+        print(f"ParallelGzipFile ({threads:>2}): {elapsed:.2f} s, {mb / elapsed:.1f} MB/s, {size} bytes "
+              f"({base_time / elapsed:.2f}x, {(size / base_size - 1) * 100:+.1f}% size)")
@@ -0,0 +1,67 @@
+"""Compare the ujson and orjson backends of `json_serialize_page()` on the write path of a JSONL part.
+
+A month of sample records, ideally a fixture dumped from a real month, is serialized a page at a time with each
+backend and written through a `BufferedCompressedWriter`, as `month_worker` does. Serialization and the whole
+path to compressed bytes are timed separately, and the decompressed output of the backends is checked to be
+identical byte for byte.
+
+Usage:
+    python -m benchmarks.json_backend [--records 20000] [--page-size 1000] [--repeat 3] [--fixture month.jsonl]
+"""
+import argparse
+import copy
+import io
+import time
+
+from alopekis.compression import Codec, get_codec
+from alopekis.serializer import check_json_backend, json_serialize_page
+from alopekis.writer import BufferedCompressedWriter
+from benchmarks.sample import sample_sources
+
+
+def serialize(pages: list, backend: str) -> tuple:
+    """Return the seconds taken to serialize every page and the JSONL bytes"""
+    pages = copy.deepcopy(pages)
+    start = time.perf_counter()
+    data = [json_serialize_page(page, backend=backend) for page in pages]
+    return time.perf_counter() - start, b"".join(data)
+
+
+def write(pages: list, backend: str, codec: Codec) -> float:
+    """Return the seconds taken to serialize and compress every page into one part"""
+    pages = copy.deepcopy(pages)
+    start = time.perf_counter()
+    writer = BufferedCompressedWriter(io.BytesIO(), codec, durability="never")
+    for page in pages:
+        writer.write(json_serialize_page(page, backend=backend))
+    writer.close()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000, help="Number of records to serialize")
+    parser.add_argument("--page-size", type=int, default=1000, help="Number of records in each page")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest is reported")
+    parser.add_argument("--fixture", type=str, default=None, help="JSONL file of raw `_source` documents")
+    args = parser.parse_args()
+
+    sources = sample_sources(args.records, args.fixture)
+    pages = [sources[i:i + args.page_size] for i in range(0, len(sources), args.page_size)]
+    codec = get_codec()
+    backends = ["ujson"]
+    try:
+        backends.append(check_json_backend("orjson"))
+    except ValueError as e:
+        print(f"{e}, skipping orjson")
+
+    outputs = {}
+    print(f"Records: {args.records} in pages of {args.page_size}, {codec.name} level {codec.level}, runs: {args.repeat}")
+    for backend in backends:
+        serialize_time = min(serialize(pages, backend)[0] for _ in range(args.repeat))
+        outputs[backend] = serialize(pages, backend)[1]
+        write_time = min(write(pages, backend, codec) for _ in range(args.repeat))
+        print(f"{backend:<6}: serialize {serialize_time:.2f} s ({args.records / serialize_time:,.0f} records/s), "
+              f"serialize and compress {write_time:.2f} s")
+    mb = len(outputs["ujson"]) / 1024 / 1024
+    print(f"JSONL: {mb:.1f} MB, identical output: {len(set(outputs.values())) == 1}")
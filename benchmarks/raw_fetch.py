@@ -0,0 +1,83 @@
+"""Compare the per-page CPU cost of the opensearch_dsl `Hit` path against the raw dictionary path.
+
+Both paths start from the decoded JSON body of a search response and end with every record in the form the
+serializers consume, plus the sort values for the next `search_after`. The difference is the cost of building
+the `Response`/`Hit` wrappers and converting them back. Serialization itself is identical for both paths and is
+reported separately for scale.
+
+Usage:
+    python -m benchmarks.raw_fetch [--pages 50] [--size 1000] [--repeat 5] [--fixture month.jsonl]
+"""
+import argparse
+import copy
+import time
+
+from opensearch_dsl import Search
+from opensearch_dsl.response import Response
+
+from alopekis.serializer import csv_serialize, json_serialize
+from benchmarks.sample import sample_response, sample_sources
+
+
+def hit_path(body: dict) -> list:
+    """Unpack a page the way `return_all_results()` does"""
+    response = Response(Search(), body)
+    records = []
+    for hit in response.hits:
+        csv_serialize(hit)
+        records.append(hit.to_dict() if hit.aasm_state == "findable" else None)
+    response.hits[-1].meta.sort
+    return records
+
+
+def raw_path(body: dict) -> list:
+    """Unpack a page the way `return_all_results(raw=True)` does"""
+    hits = body["hits"]["hits"]
+    records = []
+    for source in [hit["_source"] for hit in hits]:
+        csv_serialize(source)
+        records.append(source if source["aasm_state"] == "findable" else None)
+    hits[-1]["sort"]
+    return records
+
+
+def serialize(records: list) -> None:
+    """Serialize the findable records of a page for the JSONL output"""
+    for record in records:
+        if record is not None:
+            json_serialize(record)
+
+
+def measure(function, inputs: list, repeat: int) -> float:
+    """Return the lowest CPU seconds per input over `repeat` runs"""
+    best = None
+    for _ in range(repeat):
+        batch = [copy.deepcopy(item) for item in inputs]
+        start = time.process_time()
+        for item in batch:
+            function(item)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(inputs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=50, help="Number of pages per run")
+    parser.add_argument("--size", type=int, default=1000, help="Hits per page")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the fastest is reported")
+    parser.add_argument("--fixture", type=str, default=None, help="JSONL file of raw `_source` documents")
+    args = parser.parse_args()
+
+    body = sample_response(sample_sources(args.size, args.fixture))
+    bodies = [body] * args.pages
+
+    hit_ms = measure(hit_path, bodies, args.repeat) * 1000
+    raw_ms = measure(raw_path, bodies, args.repeat) * 1000
+    serialize_ms = measure(serialize, [raw_path(copy.deepcopy(body))] * min(args.pages, 5), 1) * 1000
+
+    print(f"Page size: {args.size}, pages: {args.pages}, runs: {args.repeat}")
+    print(f"Hit path:      {hit_ms:.2f} ms CPU per page")
+    print(f"Raw path:      {raw_ms:.2f} ms CPU per page")
+    print(f"Saved:         {hit_ms - raw_ms:.2f} ms CPU per page ({(1 - raw_ms / hit_ms) * 100:.1f}%)")
+    print(f"Serialization: {serialize_ms:.2f} ms CPU per page (same for both paths)")
@@ -0,0 +1,100 @@
+"""Sample OpenSearch records for the benchmarks.
+
+Records are either generated, or loaded from a JSONL fixture of raw `_source` documents, one per line, such as a
+dump of a real month taken with `return_all_results(raw=True)`.
+"""
+import json
+import random
+
+
+def sample_source(i: int) -> dict:
+    """Generate a plausible `_source` document for a DOI"""
+    rng = random.Random(i)
+    doi = f"10.5281/zenodo.{1000000 + i}"
+    return {
+        "uid": doi,
+        "prefix": "10.5281",
+        "suffix": f"zenodo.{1000000 + i}",
+        "identifiers": [{"identifier": f"https://zenodo.org/record/{1000000 + i}", "identifierType": "URL"}],
+        "creators": [{"name": f"Author {n}, Example", "nameType": "Personal", "givenName": "Example",
+                      "familyName": f"Author {n}", "affiliation": ["Université de Exemple"], "nameIdentifiers": []}
+                     for n in range(rng.randint(1, 8))],
+        "titles": [{"title": f"Dataset number {i} for a benchmark / test run"}],
+        "publisher_obj": {"name": "Zenodo"},
+        "container": {},
+        "publication_year": 2000 + i % 25,
+        "subjects": [{"subject": f"Subject {n}"} for n in range(rng.randint(0, 5))],
+        "contributors": [],
+        "dates": [{"date": f"{2000 + i % 25}-01-01", "dateType": "Issued"}],
+        "language": "en",
+        "types": {"resourceTypeGeneral": "Dataset", "resourceType": "", "ris": "DATA", "bibtex": "misc",
+                  "citeproc": "dataset", "schemaOrg": "Dataset"},
+        "related_identifiers": [{"relatedIdentifier": f"10.5281/zenodo.{n}", "relatedIdentifierType": "DOI",
+                                 "relationType": "IsVersionOf"} for n in range(rng.randint(0, 20))],
+        "related_items": [],
+        "sizes": [],
+        "formats": [],
+        "version_info": "1.0",
+        "rights_list": [{"rights": "Creative Commons Attribution 4.0 International",
+                         "rightsUri": "https://creativecommons.org/licenses/by/4.0/legalcode"}],
+        "descriptions": [{"description": "Lorem ipsum dolor sit amet. " * rng.randint(1, 40),
+                          "descriptionType": "Abstract"}],
+        "geo_locations": [],
+        "funding_references": [],
+        "url": f"https://zenodo.org/record/{1000000 + i}",
+        "content_url": None,
+        "metadata_version": 1,
+        "schema_version": "http://datacite.org/schema/kernel-4",
+        "source": "api",
+        "is_active": "\x01",
+        "aasm_state": "findable" if i % 5 else "registered",
+        "reason": None,
+        "view_count": rng.randint(0, 100),
+        "views_over_time": [],
+        "download_count": rng.randint(0, 100),
+        "downloads_over_time": [],
+        "reference_count": 0,
+        "citation_count": rng.randint(0, 3),
+        "citations_over_time": [],
+        "part_count": 0,
+        "part_of_count": 0,
+        "version_count": 0,
+        "version_of_count": 1,
+        "created": "2020-01-01T00:00:00.000Z",
+        "registered": "2020-01-01T00:00:00.000Z",
+        "published": None,
+        "updated": f"2020-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.000Z",
+        "client_id": "cern.zenodo",
+        "provider_id": "cern",
+        "media_ids": [],
+        "reference_ids": [],
+        "citation_ids": [f"10.1234/cite.{n}" for n in range(rng.randint(0, 3))],
+        "part_ids": [],
+        "part_of_ids": [],
+        "version_ids": [],
+        "version_of_ids": [f"10.5281/zenodo.{i}"],
+    }
+
+
+def sample_sources(count: int, fixture: str = None) -> list:
+    """Return `count` `_source` documents, cycling through the fixture file if one is given"""
+    if not fixture:
+        return [sample_source(i) for i in range(count)]
+    with open(fixture) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [records[i % len(records)] for i in range(count)]
+
+
+def sample_response(sources: list) -> dict:
+    """Wrap `_source` documents in the body of an OpenSearch search response"""
+    return {
+        "took": 12,
+        "timed_out": False,
+        "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+        "hits": {
+            "total": {"value": len(sources), "relation": "eq"},
+            "max_score": None,
+            "hits": [{"_index": "dois", "_id": s["uid"], "_score": None, "_source": s,
+                      "sort": [1577836800000 + n, s["uid"]]} for n, s in enumerate(sources)],
+        },
+    }
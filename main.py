@@ -3,17 +3,27 @@ import argparse
 import calendar
 from glob import iglob
 from logging.handlers import QueueHandler
-from multiprocessing import Process, JoinableQueue
-from queue import Queue
+from multiprocessing import Process, JoinableQueue, Value, Manager
+from multiprocessing.connection import wait
+from queue import Queue, Empty
 from datetime import datetime, date #, UTC    # UTC is new in Python 3.13 so this was erroring in prod
 import threading
 
-from alopekis.config import WORKERS, DATAFILE_BUCKET, OUTPUT_PATH, LOG_BUCKET, TOTAL_THRESHOLD, MONTH_THRESHOLD, CIRCUIT_BREAKER_THRESHOLD
+from alopekis.config import WORKERS, DATAFILE_BUCKET, S3_STAGING_PREFIX, OUTPUT_PATH, LOG_BUCKET, TOTAL_THRESHOLD, MONTH_THRESHOLD, CIRCUIT_BREAKER_THRESHOLD, PIT_REFRESH_INTERVAL, RETRY_BUDGET, OUTPUT_BACKEND, JOB_RETRIES, SUPERVISE_INTERVAL, HEARTBEAT_INTERVAL, WORKER_RESTARTS
+from alopekis.checkpoint import clear_checkpoints
+from alopekis.compression import CODECS, Codec, get_codec
+from alopekis.exceptions import TooManyRestarts
+from alopekis.incremental import load_fingerprints, save_fingerprints, month_fingerprint, month_key, month_unchanged, remove_month
+from alopekis.monitor import JobMonitor
 from alopekis.opensearch import OpenSearchClient
-from alopekis.s3 import empty_bucket, put_files
-from alopekis.utils import generate_manifest_file, queue_month
+from alopekis.scheduler import JobScheduler, load_runtimes, save_runtimes
+from alopekis.s3 import MonthUploader, abort_incomplete_uploads, delete_stale_objects, empty_bucket, empty_prefix, \
+    publish_objects, put_files
+from alopekis.serializer import check_json_backend
+from alopekis.utils import carry_month, finalize_month, generate_manifest_file, generate_manifest_from_objects, \
+    get_month_counts, queue_months
 from alopekis.worker import month_worker
-from time import sleep
+from time import sleep, time
 
 
 def logging_thread(log_queue: Queue, local=False) -> None:
@@ -50,7 +60,87 @@ def logging_thread(log_queue: Queue, local=False) -> None:
         put_files(files=[logfile, "results.csv"], bucket=LOG_BUCKET, extra_args={'ContentType': 'text/plain'})
 
 
-def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, log_queue: Queue) -> None:
+def pit_keepalive_thread(pit_client: OpenSearchClient, stop_event: threading.Event) -> None:
+    """Thread that keeps the run's point-in-time alive until the run finishes
+
+    Args:
+        pit_client (OpenSearchClient): Client holding the point-in-time ID.
+        stop_event (threading.Event): Event set when the point-in-time is no longer needed.
+    """
+    while not stop_event.wait(PIT_REFRESH_INTERVAL):
+        try:
+            pit_client.refresh_pit()
+            pit_client.logger.debug("Refreshed point-in-time keep-alive")
+        except Exception as e:
+            pit_client.logger.warning(f"Failed to refresh point-in-time keep-alive: {e}")
+
+
+def supervise_workers(workers: list, start_worker, work_queue: Queue, results_queue: Queue, current_jobs,
+                      logger: logging.Logger) -> None:
+    """Wait for every worker to stop, replacing any worker that dies before it is told to
+
+    A worker that exits with a non-zero exit code, after a `FatalWorkerError` or being killed, is replaced by a new
+    process with the same ID. The job it was processing is requeued to resume from its checkpoint, unless it has
+    used up its JOB_RETRIES attempts, in which case it is reported as failed so the run doesn't wait for it.
+
+    Workers that die without a job have nothing to requeue, and keep dying if something is wrong with the
+    environment. Once more than WORKER_RESTARTS of them have been replaced, every worker is stopped.
+
+    Args:
+        workers (list): Worker processes, indexed by worker ID and replaced in place.
+        start_worker: Function that starts a worker process for a worker ID and returns it.
+        work_queue (Queue): Queue for requeueing lost jobs.
+        results_queue (Queue): Queue for reporting failed jobs.
+        current_jobs (dict): Shared dict of the job each worker is processing, keyed by worker ID.
+        logger (logging.Logger): Logger to use.
+
+    Raises:
+        TooManyRestarts: More than WORKER_RESTARTS workers died without a job.
+    """
+    restarts = 0
+    while True:
+        for worker_id, wp in enumerate(workers):
+            if wp.exitcode is None or wp.exitcode == 0:
+                continue
+            job = current_jobs.pop(worker_id, None)
+            if job is None:
+                restarts += 1
+                if restarts > WORKER_RESTARTS:
+                    logger.error(f"Worker {worker_id} died with exit code {wp.exitcode}, {restarts} workers have died "
+                                 f"without a job, stopping every worker")
+                    for other in workers:
+                        if other.exitcode is None:
+                            other.terminate()
+                        other.join()
+                    raise TooManyRestarts(f"{restarts} workers died without a job")
+                logger.error(f"Worker {worker_id} died with exit code {wp.exitcode}, restarting it "
+                             f"(restart {restarts}/{WORKER_RESTARTS})")
+            else:
+                work_queue.task_done()
+                # The time the lost attempt ran counts towards the job's runtime
+                job['elapsed'] = job.get('elapsed', 0.0) + time() - job.pop('started')
+                label = f"{job['year']}-{job['month']}" + (f" (part {job['part'] + 1}/{job['parts']})" if job.get('parts', 1) > 1 else "")
+                attempt = job.get('attempt', 0) + 1
+                if attempt > JOB_RETRIES:
+                    logger.error(f"Worker {worker_id} died with exit code {wp.exitcode} processing job for {label}, "
+                                 f"giving up on the job after {attempt} attempts")
+                    results_queue.put({'year': job['year'], 'month': job['month'], 'count': 0,
+                                       'part': job.get('part', 0), 'parts': job.get('parts', 1), 'status': 'failed'})
+                else:
+                    logger.error(f"Worker {worker_id} died with exit code {wp.exitcode} processing job for {label}, "
+                                 f"restarting it and requeueing the job (attempt {attempt}/{JOB_RETRIES})")
+                    work_queue.put({**job, 'attempt': attempt})
+            workers[worker_id] = start_worker(worker_id)
+
+        running = [wp.sentinel for wp in workers if wp.exitcode is None]
+        if not running and all(wp.exitcode == 0 for wp in workers):
+            break
+        wait(running, timeout=SUPERVISE_INTERVAL)
+
+
+def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, log_queue: Queue, pit_id: str = None,
+                   fingerprints: dict = None, codec: Codec = None, uploader: MonthUploader = None,
+                   objects: dict = None, scheduler: JobScheduler = None, monitor: JobMonitor = None) -> None:
     """Thread that handles results
 
     Args:
@@ -58,6 +148,14 @@ def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, l
         work_queue (Queue): Queue for submitting regeneration jobs.
         worker_count (int): Number of workers (required for sending shutdown signal).
         log_queue (Queue): Queue to use for logging.
+        pit_id (str): Point-in-time ID to use for regeneration jobs.
+        fingerprints (dict): Month fingerprints to store for the next run, filled in by the main thread.
+        codec (Codec): Compression codec of the output files.
+        uploader (MonthUploader): Uploader to hand each month to as soon as it is final, if uploads overlap generation,
+            or that merges split months for the s3 output backend.
+        objects (dict): Objects uploaded for each month by the s3 output backend, filled in as months become final.
+        scheduler (JobScheduler): Scheduler that orders the jobs of reruns and records the runtime of every job.
+        monitor (JobMonitor): Monitor that follows the heartbeats of running jobs and cancels the ones that stall.
     """
     queue_handler = QueueHandler(log_queue)
     logger = logging.getLogger(f"results")
@@ -67,15 +165,43 @@ def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, l
     results = {}
     circuit_breaker = 0
     while True:
-        result = results_queue.get(block=True)
+        try:
+            # Wake up regularly to check for stalled jobs, even if no worker is sending heartbeats any more
+            result = results_queue.get(block=True, timeout=HEARTBEAT_INTERVAL if monitor and HEARTBEAT_INTERVAL else None)
+        except Empty:
+            monitor.check()
+            continue
         logger.debug(f"Got result: {result}")
+        if result is not None and result['status'] == "heartbeat":
+            if monitor:
+                monitor.heartbeat(result)
+                monitor.check()
+            continue
         if result is None:
             logger.debug("Got None, writing CSV and stopping...")
             # Write results to file
             # TODO: Name this in line with the logfile so we can keep it for analysis
             with open('results.csv', 'w') as f:
                 for key, value in results.items():
-                    f.write(f"{key},{value['expected']},{value['final']},{value['diff']},{value['pct']:0.5f}\n")
+                    # Months of an aborted run may never have finished, and have no final count
+                    pct = f"{value['pct']:0.5f}" if 'pct' in value else ""
+                    f.write(f"{key},{value.get('expected', '')},{value.get('final', '')},{value.get('diff', '')},{pct}\n")
+
+            failed = [key for key in results if results[key].get('failed')]
+            if failed:
+                logger.error(f"Jobs failed for {len(failed)} months, their output is incomplete: {failed}")
+
+            # Store fingerprints for the next incremental run, leaving out months that never finished or are still
+            # short by more than MONTH_THRESHOLD, so that the next run regenerates them rather than carrying them over
+            if fingerprints is not None:
+                unfinished = {month_key(*map(int, key.split('-'))) for key in results
+                              if 'final' not in results[key] or results[key].get('failed')
+                              or results[key]['diff'] > MONTH_THRESHOLD}
+                save_fingerprints({key: value for key, value in fingerprints.items() if key not in unfinished})
+
+            # Store the runtime of each month to order the jobs of the next run
+            if scheduler is not None:
+                save_runtimes(scheduler.updated_runtimes())
             break
 
         year = result['year']
@@ -84,15 +210,52 @@ def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, l
         status = result['status']
 
         key = f"{year}-{month}"
+        if status == "final" and result.get('retries'):
+            logger.info(f"Job for {key} retried {sum(result['retries'].values())} searches {result['retries']}, "
+                        f"sleeping for {result['retry_sleep']:.1f} seconds")
+
         if key not in results:
             results[key] = {}
         else:
             if status in results[key]:
                 logger.warning(f"Duplicate status {status} for {key}. Old value: {results[key][status]}, new value: {count}")
 
+        if status == "failed":
+            # The job used up its retries, so the month is final with whatever its other jobs wrote
+            logger.error(f"Job for {key} failed, marking the month as failed")
+            results[key]['failed'] = True
+            status = "final"
+
+        if status == "final" and scheduler is not None:
+            scheduler.job_done(result)
+        if status == "final" and monitor is not None:
+            monitor.job_done(result)
+
+        # A split month is only final once every one of its jobs has reported
+        if status == "final" and result.get('parts', 1) > 1:
+            final_parts = results[key].setdefault('final_parts', {})
+            final_parts[result['part']] = count
+            if objects is not None:
+                results[key].setdefault('final_objects', {})[result['part']] = result.get('objects', [])
+            if len(final_parts) < result['parts']:
+                continue
+            count = sum(final_parts.values())
+            logger.info(f"All {result['parts']} jobs for {key} finished with final count {count}, merging output")
+            if objects is not None:
+                # Merged on the uploader's threads, so results and heartbeats keep being handled meanwhile
+                final_objects = results[key]['final_objects']
+                uploader.merge_month(year, month, [final_objects[part] for part in sorted(final_objects)], codec,
+                                     objects)
+            else:
+                finalize_month(year, month, codec)
+        elif status == "final" and objects is not None:
+            objects[key] = result.get('objects', [])
+
         results[key][status] = count
 
         if status == "final":
+            if uploader and objects is None:
+                uploader.upload_month(year, month)
             results[key]['diff'] = results[key]['expected'] - results[key]['final']
             results[key]['pct'] = ((results[key]['diff'] / results[key]['expected']) * 100) if results[key]['expected'] > 0 else 0
 
@@ -115,6 +278,13 @@ def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, l
                         circuit_breaker += 1
                         logger.info(f"Increasing circuit breaker count, now {circuit_breaker}/{CIRCUIT_BREAKER_THRESHOLD}")
 
+                        # Recount every month to rerun in one query rather than one query per month
+                        counts = get_month_counts([tuple(int(x) for x in key.split('-')) for key in months_to_rerun],
+                                                  logger=logger, pit_id=pit_id)
+                        rerun_months = []
+                        if objects is not None:
+                            # The jobs of a split month write the objects its merge is still reading
+                            uploader.wait_merges()
                         for key in months_to_rerun:
                             # del results[key]['final']
                             # del results[key]['diff']
@@ -127,12 +297,10 @@ def results_thread(results_queue: Queue, work_queue: Queue, worker_count: int, l
                             # })
                             del results[key]
                             year, month = key.split('-')
-                            queue_month(year=int(year),
-                                        month=int(month),
-                                        work_queue=work_queue,
-                                        results_queue=results_queue,
-                                        count=None,  # Force a requery of expected count from OpenSearch
-                                        logger=logger)
+                            # Requeried above, or by queue_months
+                            rerun_months.append((int(year), int(month), counts.get((int(year), int(month)))))
+                        queue_months(rerun_months, work_queue=work_queue, results_queue=results_queue, logger=logger,
+                                     pit_id=pit_id, scheduler=scheduler)
                     else:
                         if circuit_breaker == CIRCUIT_BREAKER_THRESHOLD:
                             logger.error(f"Regenerated more than circuit breaker threshold of {CIRCUIT_BREAKER_THRESHOLD} - shutting down workers and commencing packaging")
@@ -159,8 +327,23 @@ if __name__ == "__main__":
     parser.add_argument("--from-date", type=str, default=None, help="Set start date of generation query (YYYY-MM-DD)")
     parser.add_argument("--until-date", type=str, default=None, help="Set end date of generation query (YYYY-MM-DD)")
     parser.add_argument("--single", type=str, default=None, help="Shortcut to regenerate an individual month (YYYY-MM)")
+    parser.add_argument("--no-pit", action="store_true", help="Query the live index instead of a point-in-time snapshot")
+    parser.add_argument("--incremental", action="store_true", help="Only regenerate months that changed since the previous run")
+    parser.add_argument("--codec", type=str, default=None, choices=list(CODECS), help="Override the output compression codec")
+    parser.add_argument("--level", type=int, default=None, help="Override the output compression level")
+    parser.add_argument("--overlap-upload", action="store_true", help="Upload each month to S3 as soon as it is final, while generation continues")
+    parser.add_argument("--backend", type=str, default=OUTPUT_BACKEND, choices=["local", "s3"], help="Write output files locally or stream them straight to S3")
     args = parser.parse_args()
 
+    if args.backend == "s3" and (args.local or args.incremental or args.overlap_upload):
+        exit("--backend s3 is mutually exclusive with --local, --incremental and --overlap-upload")
+
+    try:
+        codec = get_codec(args.codec, args.level)
+        json_backend = check_json_backend()
+    except ValueError as e:
+        exit(str(e))
+
     # Start the thread that handles logging
     log_queue = Queue()
     log_thread = threading.Thread(target=logging_thread, args=(log_queue, args.local,))
@@ -174,23 +357,78 @@ if __name__ == "__main__":
     logger.propagate = False
     logger.info("Data File Generation started...")
     logger.info(f"Called with arguments: {args}")
+    logger.info(f"Compressing output with {codec.name} level {codec.level}, encoding JSON with {json_backend}")
+    if args.backend == "s3":
+        logger.info(f"Streaming output straight to {DATAFILE_BUCKET}")
 
     worker_count = int(args.workers) if args.workers else int(WORKERS)
 
+    # Open a point-in-time so the expected counts and every worker see the same snapshot of the index
+    pit_client = OpenSearchClient(logger=logger)
+    pit_stop = threading.Event()
+    pit_id = None
+    if not args.no_pit:
+        try:
+            pit_id = pit_client.create_pit()
+            logger.info(f"Opened point-in-time: {pit_id}")
+            pit_thread = threading.Thread(target=pit_keepalive_thread, args=(pit_client, pit_stop,), daemon=True)
+            pit_thread.start()
+        except Exception as e:
+            logger.warning(f"Failed to open point-in-time, querying the live index instead: {e}")
+
+    # Month fingerprints from the previous run, updated with this run's as months are queued
+    fingerprints = load_fingerprints()
+    previous_fingerprints = dict(fingerprints)
+
     # Set up the queues used for handing out jobs and processing results
     work_queue = JoinableQueue()
     results_queue = JoinableQueue()
-    results_thread = threading.Thread(target=results_thread, args=(results_queue, work_queue, worker_count, log_queue,))
+    # Upload months as they finish rather than once the whole data file is generated
+    uploader = None
+    if args.overlap_upload and not args.local:
+        uploader = MonthUploader(DATAFILE_BUCKET, codec.extension, codec.content_type, prefix=S3_STAGING_PREFIX)
+        logger.info(f"Uploading months to {DATAFILE_BUCKET}/{S3_STAGING_PREFIX} as they finish")
+    elif args.backend == "s3":
+        # Output is already in the bucket, only split months are left to merge there
+        uploader = MonthUploader(DATAFILE_BUCKET, codec.extension, codec.content_type, prefix=S3_STAGING_PREFIX)
+    if uploader:
+        # Output is staged while it is generated, and only published once the whole data file is complete
+        logger.info(f"Clearing staging prefix {DATAFILE_BUCKET}/{S3_STAGING_PREFIX}")
+        empty_prefix(DATAFILE_BUCKET, S3_STAGING_PREFIX)
+
+    # Objects written by the s3 backend, which the manifest is built from
+    objects = {} if args.backend == "s3" else None
+
+    # Jobs are queued longest first, predicted from the runtimes of earlier runs
+    scheduler = JobScheduler(worker_count, load_runtimes())
+
+    # The job each worker is processing, for requeueing the job if the worker dies
+    manager = Manager()
+    current_jobs = manager.dict()
+    # Jobs cancelled by the monitor, which their worker gives back to the queue
+    cancelled_jobs = manager.dict()
+
+    # Follow the progress of running jobs from their heartbeats, cancelling the ones that stall
+    monitor = JobMonitor(logger, current_jobs, cancelled_jobs) if HEARTBEAT_INTERVAL else None
+
+    results_thread = threading.Thread(target=results_thread, args=(results_queue, work_queue, worker_count, log_queue, pit_id, fingerprints, codec, uploader, objects, scheduler, monitor,))
     results_thread.start()
 
-    workers = []
-    for i in range(worker_count):
-        wp = Process(target=month_worker, args=(i, work_queue, results_queue, log_queue))
-        workers.append(wp)
+    # Checkpoints only apply within a run
+    clear_checkpoints()
+
+    # Retries of failed searches left for the whole run, shared by every worker
+    retry_budget = Value('i', RETRY_BUDGET)
+
+    def start_worker(worker_id: int) -> Process:
+        wp = Process(target=month_worker, args=(worker_id, work_queue, results_queue, log_queue, retry_budget, codec, args.backend, current_jobs, cancelled_jobs))
         wp.start()
+        return wp
+
+    workers = [start_worker(i) for i in range(worker_count)]
 
     # Prepare the client for retrieving expected counts
-    agg_client = OpenSearchClient(logger=logger)
+    agg_client = OpenSearchClient(logger=logger, pit_id=pit_id)
     agg_client.build_query()
 
     # Add any date limitations from command line arguments
@@ -230,18 +468,31 @@ if __name__ == "__main__":
         agg_client.query = agg_client.query.filter("range", updated={"lte": f"{until_date}T23:59:59Z"})
 
     agg_client.query = agg_client.query.extra(track_total_hits=True, size=0)
-    agg_client.query.aggs.bucket('updated', 'date_histogram', field='updated', calendar_interval='month', format='yyyy-MM')
+    agg_client.query.aggs.bucket('updated', 'date_histogram', field='updated', calendar_interval='month', format='yyyy-MM') \
+        .metric('max_updated', 'max', field='updated') \
+        .metric('updated_sum', 'sum', field='updated')
 
     try:
         agg_results = agg_client.query.execute()
+        if not (from_date or until_date):
+            # Months no longer in the index at all
+            current_months = {bucket.key_as_string for bucket in agg_results.aggregations.updated.buckets}
+            for key in set(fingerprints) - current_months:
+                del fingerprints[key]
+                if args.incremental:
+                    logger.info(f"No records left for {key}, removing its output")
+                    remove_month(key)
+
+        carried_months = []
+        queued_months = []
         for bucket in agg_results.aggregations.updated.buckets:
             year, month = bucket.key_as_string.split('-')
-            queue_month(year=int(year),
-                        month=int(month),
-                        work_queue=work_queue,
-                        results_queue=results_queue,
-                        count=bucket.doc_count,
-                        logger=logger)
+            fingerprint = month_fingerprint(bucket)
+            fingerprints[month_key(int(year), int(month))] = fingerprint
+            if args.incremental and month_unchanged(int(year), int(month), fingerprint, previous_fingerprints, codec):
+                carried_months.append((int(year), int(month), bucket.doc_count))
+                continue
+            queued_months.append((int(year), int(month), bucket.doc_count))
             # work_queue.put({
             #     'year': int(year),
             #     'month': int(month),
@@ -254,6 +505,13 @@ if __name__ == "__main__":
             #     'status': 'expected'
             # })
 
+        queue_months(queued_months, work_queue=work_queue, results_queue=results_queue, logger=logger, pit_id=pit_id,
+                     scheduler=scheduler)
+
+        # Report carried months only once every changed month is queued, so they can't complete the run early
+        for year, month, count in carried_months:
+            carry_month(year=year, month=month, results_queue=results_queue, count=count, logger=logger)
+
         logger.info(f"Expected total count: {agg_results.hits.total.value}")
     except Exception as e:
         logger.error(e)
@@ -262,27 +520,102 @@ if __name__ == "__main__":
 
     finally:
 
-        # Wait for workers to finish
-        for wp in workers:
-            wp.join()
-        logger.info("Data File generation finished!")
+        # Wait for workers to finish, replacing any that die
+        aborted = False
+        try:
+            supervise_workers(workers, start_worker, work_queue, results_queue, current_jobs, logger)
+            logger.info("Data File generation finished!")
+        except TooManyRestarts as e:
+            logger.error(f"Aborting data file generation: {e}")
+            aborted = True
 
-        # Shut down results thread
+        # Shut down results thread, whose monitor still reads the shared job dicts until it stops
         results_queue.put(None)
         results_thread.join()
+        manager.shutdown()
+        logger.info(f"Makespan: predicted {scheduler.predicted_makespan():.1f}s, "
+                    f"actual {scheduler.actual_makespan():.1f}s with {worker_count} workers")
+
+        # Release the point-in-time
+        if pit_id:
+            pit_stop.set()
+            try:
+                pit_client.delete_pit()
+            except Exception as e:
+                logger.warning(f"Failed to delete point-in-time: {e}")
+
+        if aborted:
+            # Leave the previous data file in place rather than publishing an incomplete one, the staged output is
+            # cleared by the next run
+            if objects is not None:
+                abort_incomplete_uploads(DATAFILE_BUCKET, S3_STAGING_PREFIX)
+            logger.error("Data file generation was aborted, not generating the MANIFEST or publishing the data file")
+            log_queue.put(None)
+            log_thread.join()
+            exit(1)
+
+        if objects is not None:
+            # The merged objects of split months go in the manifest
+            logger.info("Waiting for month merges to finish")
+            failed = uploader.finish()
+            if failed:
+                logger.error(f"Failed to merge {len(failed)} objects, their months are left out of the manifest")
+            # The manifest lists the keys the staged objects are published to
+            objects = {key: [{**obj, 'key': obj['key'][len(S3_STAGING_PREFIX):]} for obj in month_objects]
+                       for key, month_objects in objects.items()}
 
         # Generate the manifest file
         logger.info("Generating MANIFEST file")
-        generate_manifest_file()
+        if objects is not None:
+            generate_manifest_from_objects(objects)
+        else:
+            generate_manifest_file(codec)
+
+        if objects is not None:
+            # The data files are already staged in the bucket, publish them and then the manifest listing them
+            keep = {obj['key'] for month_objects in objects.values() for obj in month_objects}
+            logger.info(f"Publishing {len(keep)} objects from {DATAFILE_BUCKET}/{S3_STAGING_PREFIX}")
+            failed = publish_objects(DATAFILE_BUCKET, sorted(keep), S3_STAGING_PREFIX, codec.content_type)
+            if failed:
+                logger.error(f"Failed to publish {len(failed)} objects")
+            put_files(files=['MANIFEST'], bucket=DATAFILE_BUCKET, extra_args={'ContentType': 'text/plain'}, root_dir=OUTPUT_PATH)
+            # Also removes the staged objects
+            removed = delete_stale_objects(DATAFILE_BUCKET, keep | {'MANIFEST'})
+            logger.info(f"Data file upload complete, removed {removed} stale objects from {DATAFILE_BUCKET}")
+            # Cancelled jobs abort their uploads, but a worker that died can't
+            aborted = abort_incomplete_uploads(DATAFILE_BUCKET, S3_STAGING_PREFIX)
+            if aborted:
+                logger.warning(f"Aborted {aborted} incomplete uploads left by workers that died")
+
+        elif uploader:
+            # Wait for the remaining month uploads, retrying any files that failed
+            logger.info("Waiting for month uploads to finish")
+            failed = uploader.finish()
+            if failed:
+                logger.warning(f"Retrying upload of {len(failed)} files")
+                put_files(files=failed, bucket=DATAFILE_BUCKET, extra_args={'ContentType': codec.content_type}, root_dir=OUTPUT_PATH, prefix=S3_STAGING_PREFIX)
+
+            # Publish the staged data file, then the manifest listing it
+            keep = set(iglob(f'dois/*/*{codec.extension}', root_dir=OUTPUT_PATH))
+            logger.info(f"Publishing {len(keep)} objects from {DATAFILE_BUCKET}/{S3_STAGING_PREFIX}")
+            failed = publish_objects(DATAFILE_BUCKET, sorted(keep), S3_STAGING_PREFIX, codec.content_type)
+            if failed:
+                logger.error(f"Failed to publish {len(failed)} objects")
+            put_files(files=['MANIFEST'], bucket=DATAFILE_BUCKET, extra_args={'ContentType': 'text/plain'}, root_dir=OUTPUT_PATH)
+
+            # The bucket was not cleared up front, so remove whatever the new data file no longer contains, and the
+            # staged objects
+            removed = delete_stale_objects(DATAFILE_BUCKET, keep | {'MANIFEST'})
+            logger.info(f"Data file upload complete, removed {removed} stale objects from {DATAFILE_BUCKET}")
 
-        if not args.local:
+        elif not args.local:
             # Clear S3 Bucket of old data file
             logger.info(f"Clearing S3 bucket: {DATAFILE_BUCKET}")
             empty_bucket(DATAFILE_BUCKET)
 
             # Upload new data file to S3
             logger.info("Uploading new data file")
-            put_files(files=iglob(f'dois/*/*.gz', root_dir=OUTPUT_PATH), bucket=DATAFILE_BUCKET, extra_args={'ContentType': 'application/gzip'}, root_dir=OUTPUT_PATH)
+            put_files(files=iglob(f'dois/*/*{codec.extension}', root_dir=OUTPUT_PATH), bucket=DATAFILE_BUCKET, extra_args={'ContentType': codec.content_type}, root_dir=OUTPUT_PATH)
             put_files(files=['MANIFEST'], bucket=DATAFILE_BUCKET, extra_args={'ContentType': 'text/plain'}, root_dir=OUTPUT_PATH)
             logger.info("Data file upload complete")
 
@@ -0,0 +1,139 @@
+import copy
+import gzip
+import os
+import threading
+from functools import partial
+from glob import glob
+from queue import Queue, Empty
+
+from alopekis import worker
+from alopekis.compression import Codec
+from alopekis.exceptions import TooManyFailures
+from alopekis.opensearch import Page
+from benchmarks.sample import sample_source
+
+RECORDS = 1000
+PAGE_SIZE = 50
+
+
+class WorkQueue(Queue):
+    """Work queue that stops the worker once it is empty, including the jobs the worker requeued"""
+    def get(self, block=True, timeout=None):
+        try:
+            return super().get(block=False)
+        except Empty:
+            return None
+
+
+class FakeOpenSearchClient:
+    """Serves a fixed month of records in pages, failing once after `fail_after_pages` pages if set, or stalling once
+    after `stall_after_pages` pages until the job is cancelled"""
+    sources = []
+    fail_after_pages = None
+    stall_after_pages = None
+    cancelled_jobs = None
+    resumed_from = []
+
+    def __init__(self, logger=None, pit_id=None, retry_budget=None):
+        self.stats = {"pages": 0, "wait_time": 0.0, "retries": {}, "retry_sleep": 0.0}
+        self.ranges = [(None, None)]
+        self.fields = None
+
+    def build_query(self, states):
+        self.state = states[0]
+
+    def filter_fields(self, fields):
+        self.fields = fields
+
+    def add_month_filter(self, year, month):
+        pass
+
+    def add_range_filter(self, gte=None, lt=None):
+        pass
+
+    def return_cursor_pages(self, ranges=None, raw=False, positions=None):
+        return [self.pages((positions or {}).get(0))]
+
+    def pages(self, after):
+        if after is not None:
+            FakeOpenSearchClient.resumed_from.append((self.state, after))
+        hits = [(i, source) for i, source in enumerate(self.sources) if source["aasm_state"] == self.state]
+        hits = [(i, source) for i, source in hits if after is None or [i, source["uid"]] > after]
+        for start in range(0, len(hits), PAGE_SIZE):
+            if self.state == "findable" and FakeOpenSearchClient.fail_after_pages is not None:
+                if FakeOpenSearchClient.fail_after_pages == 0:
+                    FakeOpenSearchClient.fail_after_pages = None
+                    raise TooManyFailures("search failed")
+                FakeOpenSearchClient.fail_after_pages -= 1
+            if self.state == "findable" and FakeOpenSearchClient.stall_after_pages is not None:
+                if FakeOpenSearchClient.stall_after_pages == 0:
+                    FakeOpenSearchClient.stall_after_pages = None
+                    # The monitor gives up on the job, which must stop even though no page arrives
+                    FakeOpenSearchClient.cancelled_jobs[0] = (2020, 1, 0, 0)
+                    threading.Event().wait(1)
+                else:
+                    FakeOpenSearchClient.stall_after_pages -= 1
+            page = hits[start:start + PAGE_SIZE]
+            sources = [copy.deepcopy({field: source[field] for field in self.fields} if self.fields else source)
+                       for _, source in page]
+            self.stats["pages"] += 1
+            yield Page(sources, [[i, source["uid"]] for i, source in page], 0)
+
+
+def run_month(output_path, monkeypatch, fail_after_pages=None, stall_after_pages=None) -> list:
+    """Generate a month with `month_worker` into `output_path` and return its results"""
+    monkeypatch.setattr(worker, "OUTPUT_PATH", str(output_path))
+    monkeypatch.setattr(worker, "OpenSearchClient", FakeOpenSearchClient)
+    monkeypatch.setattr(FakeOpenSearchClient, "sources", [sample_source(i) for i in range(RECORDS)])
+    monkeypatch.setattr(FakeOpenSearchClient, "fail_after_pages", fail_after_pages)
+    monkeypatch.setattr(FakeOpenSearchClient, "stall_after_pages", stall_after_pages)
+    monkeypatch.setattr(FakeOpenSearchClient, "cancelled_jobs", {})
+    monkeypatch.setattr(FakeOpenSearchClient, "resumed_from", [])
+    # Heartbeats are what check for cancelled jobs
+    monkeypatch.setattr(worker, "HEARTBEAT_INTERVAL", 0.05 if stall_after_pages is not None else 0)
+    # Small parts and batches, so that the failure comes after several checkpoints
+    monkeypatch.setattr(worker, "fetch_batches", partial(worker.fetch_batches, batch_size=PAGE_SIZE))
+    monkeypatch.setattr(worker, "serialize_batches", partial(worker.serialize_batches, max_records=100))
+
+    work_queue = WorkQueue()
+    results_queue = Queue()
+    work_queue.put({"year": 2020, "month": 1, "count": RECORDS})
+    worker.month_worker(0, work_queue, results_queue, Queue(), codec=Codec("gzip", 1), backend="local",
+                        cancelled_jobs=FakeOpenSearchClient.cancelled_jobs)
+    return [result for result in results_queue.queue if result["status"] != "heartbeat"]
+
+
+def read_output(output_path) -> dict:
+    """Return the decompressed contents of every output file, keyed by name"""
+    contents = {}
+    for path in sorted(glob(f"{output_path}/dois/*/*") + glob(f"{output_path}/dois/*/.parts.json")):
+        with open(path, "rb") as f:
+            data = f.read()
+        contents[os.path.basename(path)] = gzip.decompress(data) if path.endswith(".gz") else data
+    return contents
+
+
+def test_resume_after_failure_mid_part(tmp_path, monkeypatch):
+    results = run_month(tmp_path / "clean", monkeypatch)
+    assert [result["count"] for result in results] == [RECORDS]
+
+    # Fail part way through the fourth part, with three parts checkpointed
+    results = run_month(tmp_path / "resumed", monkeypatch, fail_after_pages=7)
+    assert [result["count"] for result in results] == [RECORDS]
+    assert FakeOpenSearchClient.resumed_from, "the retried job should resume from its checkpoint"
+    assert not os.path.exists(tmp_path / "resumed/dois/updated_2020-01/.checkpoint.json")
+
+    clean = read_output(tmp_path / "clean")
+    assert len([name for name in clean if name.startswith("part_")]) > 3
+    assert read_output(tmp_path / "resumed") == clean
+
+
+def test_resume_after_cancelled_stall(tmp_path, monkeypatch):
+    run_month(tmp_path / "clean", monkeypatch)
+
+    # Stall part way through the fourth part, with three parts checkpointed
+    results = run_month(tmp_path / "resumed", monkeypatch, stall_after_pages=7)
+    assert [result["count"] for result in results] == [RECORDS]
+    assert FakeOpenSearchClient.resumed_from, "the cancelled job should resume from its checkpoint"
+    assert FakeOpenSearchClient.cancelled_jobs == {}
+    assert read_output(tmp_path / "resumed") == read_output(tmp_path / "clean")
@@ -0,0 +1,52 @@
+import gzip
+import io
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from alopekis.compression import ParallelGzipFile
+
+BLOCK_SIZE = 64 * 1024
+
+
+def sample_data(size: int) -> bytes:
+    """Compressible but not trivially repetitive data, so that blocks refer back across block boundaries"""
+    rng = random.Random(size)
+    words = [bytes(rng.choices(range(97, 123), k=rng.randint(2, 10))) for _ in range(500)]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words) + b" "
+    return bytes(data[:size])
+
+
+def compress(chunks, level: int = 6, threads: int = 4) -> bytes:
+    raw_file = io.BytesIO()
+    with ParallelGzipFile(raw_file, compresslevel=level, block_size=BLOCK_SIZE, threads=threads) as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return raw_file.getvalue()
+
+
+@pytest.mark.parametrize("size", [0, 1, BLOCK_SIZE, 10 * BLOCK_SIZE + 123])
+@pytest.mark.parametrize("level", [1, 6, 9])
+def test_output_decompresses_with_gzip(size, level):
+    data = sample_data(size)
+    # Writes of uneven sizes, so that blocks are assembled across writes
+    chunks = [data[i:i + 10007] for i in range(0, len(data), 10007)]
+    assert gzip.decompress(compress(chunks, level)) == data
+
+
+def test_concatenated_members_decompress_as_one_stream():
+    first, second = sample_data(3 * BLOCK_SIZE), sample_data(2 * BLOCK_SIZE + 7)
+    assert gzip.decompress(compress([first]) + compress([second])) == first + second
+
+
+@pytest.mark.skipif(shutil.which("gzip") is None, reason="gzip is not installed")
+def test_output_decompresses_with_gzip_command(tmp_path):
+    data = sample_data(5 * BLOCK_SIZE + 1)
+    path = tmp_path / "part.jsonl.gz"
+    path.write_bytes(compress([data]))
+    subprocess.run(["gzip", "-t", str(path)], check=True)
+    assert subprocess.run(["gzip", "-dc", str(path)], check=True, capture_output=True).stdout == data
@@ -0,0 +1,84 @@
+import logging
+
+import pytest
+
+from alopekis import monitor
+from alopekis.monitor import JobMonitor
+
+logger = logging.getLogger("test")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(monitor.time, "monotonic", clock)
+    return clock
+
+
+def beat(count: int, worker: int = 0, attempt: int = 0) -> dict:
+    return {"worker": worker, "year": 2020, "month": 1, "part": 0, "parts": 1, "attempt": attempt,
+            "expected": 1000, "count": count, "pages": count // 100, "bytes": count * 1000, "search_after": {}}
+
+
+def current(attempt: int = 0) -> dict:
+    return {"year": 2020, "month": 1, "count": 1000, "attempt": attempt}
+
+
+def test_stall_after_timeout_is_cancelled(clock):
+    current_jobs, cancelled_jobs = {0: current(attempt=2)}, {}
+    job_monitor = JobMonitor(logger, current_jobs, cancelled_jobs, stall_timeout=60)
+
+    job_monitor.heartbeat(beat(100, attempt=2))
+    clock.now = 50
+    job_monitor.heartbeat(beat(200, attempt=2))
+    # Heartbeats without progress don't hold off the timeout
+    clock.now = 100
+    job_monitor.heartbeat(beat(200, attempt=2))
+    assert job_monitor.check() == []
+    assert cancelled_jobs == {}
+
+    clock.now = 111
+    assert job_monitor.check() == [0]
+    # The mark names the attempt, so the worker ignores it once it has moved on to another job
+    assert cancelled_jobs == {0: (2020, 1, 0, 2)}
+    assert job_monitor.check() == []
+
+
+def test_stall_without_cancel(clock):
+    cancelled_jobs = {}
+    job_monitor = JobMonitor(logger, {0: current()}, cancelled_jobs, stall_timeout=60, cancel=False)
+    job_monitor.heartbeat(beat(100))
+    clock.now = 61
+    assert job_monitor.check() == [0]
+    assert cancelled_jobs == {}
+
+
+def test_requeued_job_is_ignored(clock):
+    # The worker died and its job was requeued, or it gave up on the job and moved on to its next attempt
+    current_jobs, cancelled_jobs = {0: current(attempt=1)}, {}
+    job_monitor = JobMonitor(logger, current_jobs, cancelled_jobs, stall_timeout=60)
+    job_monitor.heartbeat(beat(100, attempt=0))
+    job_monitor.heartbeat(beat(100, worker=1))
+    clock.now = 61
+    assert job_monitor.check() == []
+    assert cancelled_jobs == {}
+    assert job_monitor.jobs == {}
+
+
+def test_finished_job_is_forgotten(clock):
+    job_monitor = JobMonitor(logger, {0: current()}, {}, stall_timeout=60)
+    job_monitor.heartbeat(beat(100))
+    clock.now = 10
+    job_monitor.heartbeat(beat(600))
+    assert job_monitor.jobs[0]["rate"] == 50
+    job_monitor.job_done({"year": 2020, "month": 1, "count": 1000})
+    clock.now = 100
+    assert job_monitor.check() == []
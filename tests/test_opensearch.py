@@ -0,0 +1,63 @@
+import logging
+import threading
+
+from alopekis.opensearch import OpenSearchClient, merge_slices
+
+BOUNDARY = "2020-01-16T00:00:00Z"
+RANGES = [(None, BOUNDARY), (BOUNDARY, None)]
+HITS_PER_PAGE = 2
+
+
+def fake_hits(state: str, days: range) -> list:
+    return [({"uid": f"10.1234/{state}-{day}", "aasm_state": state}, [f"2020-01-{day:02d}T00:00:00Z", f"{state}-{day}"])
+            for day in days]
+
+
+class FakeIndex:
+    """Serves the hits of each slice in pages, holding back the last page of the first slice until the second
+    slice has been fetched to the end"""
+    def __init__(self, hits):
+        self.hits = hits
+        self.second_slice_done = threading.Event()
+        self.stalled = False
+
+    def execute_page(self, query, raw=False):
+        body = query.to_dict()
+        ranges = [f["range"]["updated"] for f in body["query"]["bool"]["filter"] if "range" in f]
+        first_slice = any(r.get("lt") == BOUNDARY for r in ranges)
+        hits = [(source, sort) for source, sort in self.hits if (sort[0] < BOUNDARY) == first_slice]
+        after = body.get("search_after")
+        hits = [(source, sort) for source, sort in hits if after is None or sort > after][:HITS_PER_PAGE]
+        if not first_slice and not hits:
+            self.second_slice_done.set()
+        if first_slice and len(hits) < HITS_PER_PAGE and not self.second_slice_done.wait(5):
+            self.stalled = True
+        return False, [source for source, _ in hits], [sort for _, sort in hits], 3
+
+
+def client(state: str, index: FakeIndex) -> OpenSearchClient:
+    client = OpenSearchClient(logger=logging.getLogger("test"))
+    client.build_query(states=[state])
+    client._execute_page = index.execute_page
+    return client
+
+
+def test_slices_are_fetched_concurrently():
+    # Far more pages in the second slice than can be fetched ahead while the first one is incomplete
+    findable = FakeIndex(fake_hits("findable", range(1, 32)))
+    registered = FakeIndex(fake_hits("registered", range(2, 32, 3)))
+    registered.second_slice_done.set()
+
+    streams = {state: client(state, index).return_cursor_pages(RANGES, raw=True, prefetch=1)
+               for state, index in (("findable", findable), ("registered", registered))}
+    records = list(merge_slices(streams, depth=1, chunk_size=1))
+
+    assert not findable.stalled, "the second slice waited for the first one to be written"
+    assert len(records) == len(findable.hits) + len(registered.hits)
+    # Each slice comes in sort order, merging both states
+    for cursor in (0, 1):
+        sorts = [sort for _, c, sort, _ in records if c == cursor]
+        assert sorts == sorted(sorts)
+        assert {state for state, c, _, _ in records if c == cursor} == {"findable", "registered"}
+    assert {hit["uid"] for _, _, _, hit in records} == \
+        {source["uid"] for source, _ in findable.hits + registered.hits}
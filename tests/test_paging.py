@@ -0,0 +1,46 @@
+from alopekis.paging import AdaptivePageSize
+
+MB = 1024 * 1024
+
+
+def page_size(size: int = 1000) -> AdaptivePageSize:
+    return AdaptivePageSize(size=size, min_size=100, max_size=5000, target_took=1000, max_bytes=10 * MB)
+
+
+def test_shrinks_on_timeout():
+    pages = page_size()
+    assert pages.update(timed_out=True) == 500
+    assert pages.update(timed_out=True) == 250
+    # Never below the smallest size
+    assert pages.update(timed_out=True) == 125
+    assert pages.update(timed_out=True) == 100
+
+
+def test_shrinks_to_bring_slow_or_large_pages_within_limits():
+    assert page_size().update(took=4000, nbytes=MB) == 250
+    assert page_size().update(took=500, nbytes=40 * MB) == 250
+    # The further limit decides
+    assert page_size().update(took=2500, nbytes=20 * MB) == 400
+    assert page_size().update(took=100000) == 100
+
+
+def test_grows_on_fast_small_pages():
+    pages = page_size()
+    assert pages.update(took=100, nbytes=MB) == 1500
+    # Without projecting past half the byte limit
+    assert pages.update(took=100, nbytes=4 * MB) == 1875
+    assert pages.update(took=100, nbytes=5 * MB) == 1875
+    # Never above the largest size
+    assert page_size(4000).update(took=100) == 5000
+
+
+def test_steady_between_the_limits():
+    pages = page_size()
+    assert pages.update(took=1500, nbytes=MB) == 1000
+    assert pages.update(took=100, nbytes=6 * MB) == 1000
+    assert pages.update(took=1999, nbytes=10 * MB) == 1000
+
+
+def test_initial_size_is_clamped():
+    assert page_size(10).size == 100
+    assert page_size(10000).size == 5000
@@ -0,0 +1,45 @@
+import json
+from queue import Queue
+
+import main
+from alopekis import incremental, scheduler
+from alopekis.scheduler import JobScheduler
+
+
+def test_shutdown_with_unfinished_month(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(incremental, "OUTPUT_PATH", str(tmp_path))
+    monkeypatch.setattr(scheduler, "OUTPUT_PATH", str(tmp_path))
+    fingerprints = {"2020-01": {"count": 10}, "2020-02": {"count": 20}}
+
+    results_queue = Queue()
+    results_queue.put({"year": 2020, "month": 1, "count": 10, "status": "expected"})
+    results_queue.put({"year": 2020, "month": 2, "count": 20, "status": "expected"})
+    results_queue.put({"year": 2020, "month": 1, "count": 10, "status": "final", "elapsed": 2.0})
+    # The run is aborted before February finishes
+    results_queue.put(None)
+    main.results_thread(results_queue, Queue(), 1, Queue(), fingerprints=fingerprints,
+                        scheduler=JobScheduler(1))
+
+    assert (tmp_path / "results.csv").read_text() == "2020-1,10,10,0,0.00000\n2020-2,20,,,\n"
+    # The unfinished month is regenerated by the next run
+    assert json.loads((tmp_path / incremental.FINGERPRINTS_FILE).read_text()) == {"2020-01": {"count": 10}}
+    assert json.loads((tmp_path / scheduler.RUNTIMES_FILE).read_text()) == {"2020-01": 0.2}
+
+
+def test_shutdown_without_output_directory(tmp_path, monkeypatch):
+    # The s3 backend writes its output to the bucket, so OUTPUT_PATH may not exist yet
+    output_path = tmp_path / "output"
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(incremental, "OUTPUT_PATH", str(output_path))
+    monkeypatch.setattr(scheduler, "OUTPUT_PATH", str(output_path))
+
+    results_queue = Queue()
+    results_queue.put({"year": 2020, "month": 1, "count": 10, "status": "expected"})
+    results_queue.put({"year": 2020, "month": 1, "count": 10, "status": "final", "elapsed": 2.0})
+    results_queue.put(None)
+    main.results_thread(results_queue, Queue(), 1, Queue(), fingerprints={"2020-01": {"count": 10}},
+                        scheduler=JobScheduler(1))
+
+    assert json.loads((output_path / incremental.FINGERPRINTS_FILE).read_text()) == {"2020-01": {"count": 10}}
+    assert json.loads((output_path / scheduler.RUNTIMES_FILE).read_text()) == {"2020-01": 0.2}
@@ -0,0 +1,70 @@
+import logging
+from multiprocessing import Value
+
+import pytest
+from opensearchpy.exceptions import ConnectionError, ConnectionTimeout, NotFoundError, TransportError
+
+from alopekis import retry
+from alopekis.exceptions import TooManyFailures, TooManyTimeouts
+from alopekis.retry import RetryPolicy, classify_failure
+
+logger = logging.getLogger("test")
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Sleep for no time, with the jitter always picking the longest delay"""
+    sleeps = []
+    monkeypatch.setattr(retry.time, "sleep", sleeps.append)
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+    return sleeps
+
+
+def test_classify_failure():
+    assert classify_failure(TransportError(429, "too_many_requests")) == "throttled"
+    assert classify_failure(TransportError(503, "unavailable")) == "unavailable"
+    assert classify_failure(ConnectionTimeout("TIMEOUT", "timed out", None)) == "timeout"
+    assert classify_failure(ConnectionError("N/A", "connection reset", None)) == "connection"
+    assert classify_failure(NotFoundError(404, "search_context_missing_exception")) == "failure"
+    assert classify_failure(ValueError("bad page")) == "failure"
+
+
+def test_backoff_by_kind(sleeps):
+    policy = RetryPolicy(logger, base_delay=1, max_delay=10)
+    policy.failed("throttled")
+    policy.failed("throttled")
+    policy.failed("connection")
+    # Capped at the longest delay
+    policy.failed("unavailable")
+    policy.succeeded()
+    policy.failed("timeout")
+    policy.failed("connection")
+    assert sleeps == [4, 8, 2, 10, 2, 1]
+    assert policy.sleep_time == sum(sleeps)
+    assert policy.retries == {"throttled": 2, "connection": 2, "unavailable": 1, "timeout": 1}
+
+
+def test_timeouts_and_failures_capped_separately(sleeps):
+    policy = RetryPolicy(logger, max_failures=2, max_timeouts=1)
+    policy.failed("timeout")
+    policy.failed("throttled")
+    policy.failed("connection")
+    with pytest.raises(TooManyTimeouts):
+        policy.failed("timeout")
+    with pytest.raises(TooManyFailures):
+        policy.failed("unavailable")
+    assert len(sleeps) == 3
+
+
+def test_shared_budget_exhausted(sleeps):
+    budget = Value("i", 3)
+    first, second = RetryPolicy(logger, budget=budget), RetryPolicy(logger, budget=budget)
+    first.failed("throttled")
+    second.failed("connection")
+    second.failed("timeout")
+    assert budget.value == 0
+    with pytest.raises(TooManyFailures):
+        first.failed("throttled")
+    with pytest.raises(TooManyTimeouts):
+        second.failed("timeout")
+    assert len(sleeps) == 3
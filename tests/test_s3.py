@@ -0,0 +1,123 @@
+import gzip
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from alopekis import s3
+from alopekis.compression import Codec
+from alopekis.s3 import S3MultipartFile, empty_prefix, merge_month_objects, publish_objects
+
+BUCKET = "datafile"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+    monkeypatch.setattr(s3, "S3_ENDPOINT_URL", None)
+    # Don't reuse a client created outside the mock
+    monkeypatch.setattr(s3, "_client_pid", None)
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def read_object(client, key: str) -> bytes:
+    return client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def keys(client) -> list:
+    return sorted(obj["Key"] for obj in client.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+
+def test_multipart_file_small_object_is_put(client):
+    with S3MultipartFile(BUCKET, "small.txt", content_type="text/plain") as f:
+        f.write(b"hello ")
+        f.write(b"world")
+    assert read_object(client, "small.txt") == b"hello world"
+    assert f.size == 11
+    assert f.parts == []
+    assert client.head_object(Bucket=BUCKET, Key="small.txt")["ContentType"] == "text/plain"
+
+
+def test_multipart_file_uploads_parts(client):
+    data = bytes(range(256)) * (12 * MB // 256)
+    with S3MultipartFile(BUCKET, "large.bin", part_size=5 * MB) as f:
+        for i in range(0, len(data), MB):
+            f.write(data[i:i + MB])
+    assert read_object(client, "large.bin") == data
+    assert [part["PartNumber"] for part in f.parts] == [1, 2, 3]
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_multipart_file_aborts_on_exception(client):
+    with pytest.raises(RuntimeError):
+        with S3MultipartFile(BUCKET, "failed.bin", part_size=5 * MB) as f:
+            f.write(b"x" * 6 * MB)
+            raise RuntimeError("write failed")
+    assert keys(client) == []
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_merge_month_objects(client):
+    codec = Codec("gzip", 6)
+    prefix = "staging/dois/updated_2023-01"
+    job_objects = []
+    jsonl = []
+    csv = []
+    for job in range(2):
+        objects = []
+        for part in range(2):
+            body = f'{{"job": {job}, "part": {part}}}\n'.encode()
+            jsonl.append(body)
+            key = f"{prefix}/sub{job:03d}_part_{part:04d}.jsonl.gz"
+            client.put_object(Bucket=BUCKET, Key=key, Body=gzip.compress(body))
+            objects.append({"key": key, "size": 0, "count": 1})
+        # Only the first job writes the header
+        rows = f"10.1234/{job},findable,a.b,2023-01-01\n".encode()
+        if job == 0:
+            rows = b"doi,state,client_id,updated\n" + rows
+        csv.append(rows)
+        key = f"{prefix}/sub{job:03d}_2023-01.csv.gz"
+        client.put_object(Bucket=BUCKET, Key=key, Body=gzip.compress(rows))
+        objects.append({"key": key, "size": 0, "count": 1})
+        job_objects.append(objects)
+
+    merged = merge_month_objects(BUCKET, 2023, 1, job_objects, codec, "staging/")
+
+    assert [obj["key"] for obj in merged] == [f"{prefix}/part_{i:04d}.jsonl.gz" for i in range(4)] + \
+        [f"{prefix}/2023-01.csv.gz"]
+    assert keys(client) == sorted(obj["key"] for obj in merged)
+    for obj, body in zip(merged, jsonl):
+        assert gzip.decompress(read_object(client, obj["key"])) == body
+        assert obj["count"] == 1
+    csv_object = merged[-1]
+    assert gzip.decompress(read_object(client, csv_object["key"])) == b"".join(csv)
+    assert csv_object["count"] == 2
+    assert csv_object["size"] == len(read_object(client, csv_object["key"]))
+
+
+def test_publish_staged_objects(client):
+    client.put_object(Bucket=BUCKET, Key="dois/updated_2023-01/part_0000.jsonl.gz", Body=b"old")
+    client.put_object(Bucket=BUCKET, Key="staging/dois/updated_2023-01/part_0000.jsonl.gz", Body=b"new")
+    client.put_object(Bucket=BUCKET, Key="staging/dois/updated_2023-02/part_0000.jsonl.gz", Body=b"added")
+    client.create_multipart_upload(Bucket=BUCKET, Key="staging/dois/updated_2023-03/part_0000.jsonl.gz")
+
+    failed = publish_objects(BUCKET, ["dois/updated_2023-01/part_0000.jsonl.gz", "dois/updated_2023-02/part_0000.jsonl.gz",
+                                      "dois/updated_2023-03/part_0000.jsonl.gz"], "staging/", "application/gzip")
+
+    # The upload left incomplete was never staged
+    assert failed == ["dois/updated_2023-03/part_0000.jsonl.gz"]
+    assert read_object(client, "dois/updated_2023-01/part_0000.jsonl.gz") == b"new"
+    assert read_object(client, "dois/updated_2023-02/part_0000.jsonl.gz") == b"added"
+    assert client.head_object(Bucket=BUCKET, Key="dois/updated_2023-02/part_0000.jsonl.gz")["ContentType"] == \
+        "application/gzip"
+
+    empty_prefix(BUCKET, "staging/")
+    assert keys(client) == ["dois/updated_2023-01/part_0000.jsonl.gz", "dois/updated_2023-02/part_0000.jsonl.gz"]
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=BUCKET)
@@ -0,0 +1,40 @@
+from alopekis.incremental import month_key
+from alopekis.scheduler import JobScheduler, lpt_makespan
+
+
+def job(month: int, count: int) -> dict:
+    return {"year": 2020, "month": month, "count": count}
+
+
+def test_lpt_makespan():
+    assert lpt_makespan([5, 4, 3, 3, 2], 2) == 9
+    assert lpt_makespan([5, 4], 4) == 5
+    assert lpt_makespan([], 2) == 0
+
+
+def test_predicted_at_default_rate_without_history():
+    scheduler = JobScheduler(2, default_rate=0.5)
+    jobs, makespan = scheduler.order([job(1, 10), job(2, 30), job(3, 20), job(4, None)])
+    assert [j["month"] for j in jobs] == [2, 3, 1, 4]
+    # 15s and 10s + 5s on the two workers
+    assert makespan == 15
+    assert scheduler.predicted_makespan() == 15
+
+
+def test_predicted_from_history():
+    # February is slow per record, and March has no history so is predicted at the mean rate
+    runtimes = {month_key(2020, 1): 0.1, month_key(2020, 2): 1.0}
+    scheduler = JobScheduler(1, runtimes, default_rate=100)
+    jobs, makespan = scheduler.order([job(1, 100), job(2, 20), job(3, 10)])
+    assert [j["month"] for j in jobs] == [2, 1, 3]
+    assert makespan == 20 + 10 + 5.5
+    # Reruns are queued as another batch once the first one is done
+    _, rerun = scheduler.order([job(2, 1)])
+    assert scheduler.predicted_makespan() == makespan + rerun == 36.5
+
+
+def test_runtimes_include_earlier_attempts():
+    scheduler = JobScheduler(1)
+    scheduler.job_done({"year": 2020, "month": 1, "count": 100, "elapsed": 30.0})
+    scheduler.job_done({"year": 2020, "month": 1, "count": 100, "elapsed": 10.0})
+    assert scheduler.updated_runtimes() == {month_key(2020, 1): 0.2}
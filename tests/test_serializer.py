@@ -0,0 +1,47 @@
+import pytest
+
+from alopekis.serializer import json_serialize_page
+from benchmarks.sample import sample_source
+
+orjson = pytest.importorskip("orjson")
+
+# Values where the two encoders are known to differ, or could plausibly differ
+EDGE_VALUES = [
+    1e20, 1.5e+300, -2.5e16, 1e-7, 1.5e-300, 0.1, 123456.789, 1e16, 0.0, -0.0,
+    1e-5, 1.23e-5, -5e-5, 9.99e-5, 1e-4, 1e-6, 1e15, 9999999999999998.0,
+    2 ** 63 - 1, 2 ** 63, 2 ** 64 - 1, -2 ** 63, -2 ** 63 - 1, 2 ** 64, 10 ** 30, -10 ** 30,
+    "é ü 漢字 🙂", "a/b</script>", "tab\there \"quoted\" back\\slash", "\x00\x01\x1f\x7f", "  ",
+    None, True, False, [], {},
+]
+
+
+def edge_source(i: int) -> dict:
+    source = sample_source(i)
+    value = EDGE_VALUES[i % len(EDGE_VALUES)]
+    source["view_count"] = value
+    source["citations_over_time"] = [{"year": 2020, "total": value}]
+    source["descriptions"].append({"description": value, "descriptionType": "Other"})
+    return source
+
+
+@pytest.mark.parametrize("make_source", [sample_source, edge_source])
+def test_orjson_matches_ujson(make_source):
+    # Serializing modifies the records in place, so each backend gets its own
+    count = 3 * len(EDGE_VALUES)
+    ujson_page = json_serialize_page([make_source(i) for i in range(count)], backend="ujson")
+    orjson_page = json_serialize_page([make_source(i) for i in range(count)], backend="orjson")
+    assert orjson_page == ujson_page
+    assert orjson_page.count(b"\n") == count
+
+
+@pytest.mark.parametrize("value", EDGE_VALUES)
+def test_orjson_matches_ujson_on_each_value(value):
+    def source():
+        source = sample_source(0)
+        source["view_count"] = value
+        return source
+    assert json_serialize_page([source()], backend="orjson") == json_serialize_page([source()], backend="ujson")
+
+
+def test_empty_page():
+    assert json_serialize_page([], backend="orjson") == json_serialize_page([], backend="ujson") == b""
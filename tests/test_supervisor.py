@@ -0,0 +1,47 @@
+import logging
+import sys
+from multiprocessing import Process
+from queue import Queue
+
+import pytest
+
+import main
+from alopekis.exceptions import TooManyRestarts
+
+logger = logging.getLogger("test")
+
+
+def starter(exitcodes: list):
+    """Return a `start_worker` that starts workers exiting with each of `exitcodes` in turn"""
+    started = []
+
+    def start_worker(worker_id: int) -> Process:
+        wp = Process(target=sys.exit, args=(exitcodes[min(len(started), len(exitcodes) - 1)],))
+        wp.start()
+        started.append(worker_id)
+        return wp
+    return start_worker, started
+
+
+@pytest.fixture(autouse=True)
+def restarts(monkeypatch):
+    monkeypatch.setattr(main, "WORKER_RESTARTS", 3)
+    monkeypatch.setattr(main, "SUPERVISE_INTERVAL", 0.01)
+
+
+def test_workers_that_keep_dying_abort_the_run():
+    start_worker, started = starter([1])
+    workers = [start_worker(i) for i in range(2)]
+    with pytest.raises(TooManyRestarts):
+        main.supervise_workers(workers, start_worker, Queue(), Queue(), {}, logger)
+    # The two workers and the three restarts allowed
+    assert len(started) == 5
+    assert all(wp.exitcode is not None for wp in workers)
+
+
+def test_workers_restarted_within_the_cap():
+    start_worker, started = starter([1, 1, 1, 0])
+    workers = [start_worker(i) for i in range(2)]
+    main.supervise_workers(workers, start_worker, Queue(), Queue(), {}, logger)
+    assert len(started) == 5
+    assert all(wp.exitcode == 0 for wp in workers)
@@ -0,0 +1,75 @@
+import gzip
+import json
+import os
+
+from alopekis import utils
+from alopekis.compression import Codec
+from alopekis.opensearch import OpenSearchClient
+from alopekis.utils import finalize_month, plan_month_jobs
+
+HEADER = b"doi,state,client_id,updated\n"
+
+
+def write(path, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data))
+
+
+def test_finalize_month(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "OUTPUT_PATH", str(tmp_path))
+    output_dir = tmp_path / "dois/updated_2020-01"
+    output_dir.mkdir(parents=True)
+    # Parts left over from an earlier generation, one beyond the parts of this one
+    write(output_dir / "part_0000.jsonl.gz", b"stale\n")
+    write(output_dir / "part_0005.jsonl.gz", b"stale\n")
+
+    parts = {"sub000_part_0000.jsonl.gz": b'{"a": 1}\n{"a": 2}\n', "sub000_part_0001.jsonl.gz": b'{"a": 3}\n',
+             "sub001_part_0000.jsonl.gz": b'{"b": 1}\n{"b": 2}\n{"b": 3}\n'}
+    for name, data in parts.items():
+        write(output_dir / name, data)
+    # Only the first job writes the CSV header
+    write(output_dir / "sub000_2020-01.csv.gz", HEADER + b"10.1234/a1\n10.1234/a2\n10.1234/a3\n")
+    write(output_dir / "sub001_2020-01.csv.gz", b"10.1234/b1\n10.1234/b2\n10.1234/b3\n")
+    (output_dir / ".sub000_parts.json").write_text(json.dumps(
+        {"sub000_part_0000.jsonl.gz": 2, "sub000_part_0001.jsonl.gz": 1, "sub000_2020-01.csv.gz": 3}))
+    (output_dir / ".sub001_parts.json").write_text(json.dumps(
+        {"sub001_part_0000.jsonl.gz": 3, "sub001_2020-01.csv.gz": 3}))
+
+    finalize_month(2020, 1, Codec("gzip", 1))
+
+    assert sorted(os.listdir(output_dir)) == [".parts.json", "2020-01.csv.gz", "part_0000.jsonl.gz",
+                                              "part_0001.jsonl.gz", "part_0002.jsonl.gz"]
+    for index, data in enumerate(parts.values()):
+        assert gzip.decompress((output_dir / f"part_{index:04d}.jsonl.gz").read_bytes()) == data
+    csv = gzip.decompress((output_dir / "2020-01.csv.gz").read_bytes())
+    assert csv.count(HEADER) == 1 and csv.startswith(HEADER)
+    assert csv.splitlines()[1:] == [b"10.1234/a1", b"10.1234/a2", b"10.1234/a3", b"10.1234/b1", b"10.1234/b2",
+                                    b"10.1234/b3"]
+    assert json.loads((output_dir / ".parts.json").read_text()) == {
+        "part_0000.jsonl.gz": 2, "part_0001.jsonl.gz": 1, "part_0002.jsonl.gz": 3, "2020-01.csv.gz": 6}
+
+
+def test_plan_month_jobs(monkeypatch):
+    days = [("2020-01-01T00:00:00Z", 30), ("2020-01-02T00:00:00Z", 40), ("2020-01-03T00:00:00Z", 250),
+            ("2020-01-04T00:00:00Z", 20)]
+    # The third day is above the budget, with one hour that is above it on its own
+    hours = [("2020-01-03T00:00:00Z", 60), ("2020-01-03T01:00:00Z", 150), ("2020-01-03T05:00:00Z", 40)]
+    hourly_ranges = []
+
+    def get_histogram(self, interval):
+        if interval == "1h":
+            hourly_ranges.extend(f["range"]["updated"] for f in self.query.to_dict()["query"]["bool"]["filter"]
+                                 if "range" in f)
+            return hours
+        return days
+    monkeypatch.setattr(OpenSearchClient, "get_histogram", get_histogram)
+
+    assert plan_month_jobs(2020, 1, 340, budget=100) == [
+        (None, "2020-01-03T00:00:00Z", 70),
+        ("2020-01-03T00:00:00Z", "2020-01-03T01:00:00Z", 60),
+        ("2020-01-03T01:00:00Z", "2020-01-03T05:00:00Z", 150),
+        ("2020-01-03T05:00:00Z", None, 60),
+    ]
+    assert {"gte": "2020-01-03T00:00:00Z", "lt": "2020-01-04T00:00:00Z"} in hourly_ranges
+    # A month within the budget is a single job, without querying the histogram
+    assert plan_month_jobs(2020, 1, 100, budget=100) == [(None, None, 100)]